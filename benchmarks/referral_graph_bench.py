@@ -0,0 +1,160 @@
+"""
+In-memory ReferralGraph vs the per-node / per-level SQLite queries used before it.
+
+    python benchmarks/referral_graph_bench.py [--users 1000000] [--roots 200] [--depth 10]
+
+Builds a random referral forest in a temporary SQLite file (users table with the same indexes
+as the bot), then times for random users:
+  ancestors - walk to the top, one "SELECT referrer_telegram_id WHERE telegram_id = ?" per hop
+  subtree   - load_tree_levels() style BFS, one "WHERE referrer_telegram_id IN (...)" per level
+against the same walks on a ReferralGraph loaded from one bulk query, and prints its memory.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from sqlite_engine import create_engine_for
+from referral_graph import ReferralGraph
+
+IN_CHUNK_SIZE = 500
+
+
+def populate(path: str, users: int, seed: int = 42):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER NOT NULL UNIQUE, referrer_telegram_id INTEGER)")
+    conn.execute("CREATE INDEX ix_users_referrer ON users (referrer_telegram_id)")
+    base = 10_000_000
+    rows = ((base + i, base + rnd.randrange(i) if i and rnd.random() > 0.001 else None) for i in range(users))
+    conn.executemany("INSERT INTO users (telegram_id, referrer_telegram_id) VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+async def sql_ancestors(conn, tid: int):
+    out = []
+    seen = {tid}
+    while True:
+        ref = (await conn.execute(text("SELECT referrer_telegram_id FROM users WHERE telegram_id = :t"), {"t": tid})).scalar()
+        if ref is None or ref in seen:
+            return out
+        out.append(ref)
+        seen.add(ref)
+        tid = ref
+
+
+async def sql_subtree(conn, root: int, max_depth: int):
+    children = {}
+    seen = {root}
+    frontier = [root]
+    for _ in range(max_depth):
+        nxt = []
+        for i in range(0, len(frontier), IN_CHUNK_SIZE):
+            chunk = frontier[i:i + IN_CHUNK_SIZE]
+            params = {f"p{j}": v for j, v in enumerate(chunk)}
+            q = text(f"SELECT telegram_id, referrer_telegram_id FROM users WHERE referrer_telegram_id IN ({', '.join(':' + k for k in params)}) ORDER BY id")
+            for tid, ref in (await conn.execute(q, params)).all():
+                if tid not in seen:
+                    seen.add(tid)
+                    children.setdefault(ref, []).append(tid)
+                    nxt.append(tid)
+        if not nxt:
+            break
+        frontier = nxt
+    return children
+
+
+def report(name: str, seconds: float, calls: int):
+    print(f"  {name:22s} total={seconds:8.3f}s  per call={seconds / calls * 1000:9.3f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--roots", type=int, default=200)
+    parser.add_argument("--depth", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "graph.db")
+        started = time.perf_counter()
+        populate(path, args.users)
+        print(f"populated {args.users} users in {time.perf_counter() - started:.1f}s")
+        rnd = random.Random(7)
+        sample = [10_000_000 + rnd.randrange(args.users) for _ in range(args.roots)]
+
+        engine = create_engine_for(f"sqlite+aiosqlite:///{path}")
+        async with engine.connect() as conn:
+            started = time.perf_counter()
+            rows = (await conn.execute(text("SELECT telegram_id, referrer_telegram_id FROM users ORDER BY id"))).all()
+            loaded = time.perf_counter() - started
+            graph = ReferralGraph()
+            started = time.perf_counter()
+            graph.build(rows)
+            built = time.perf_counter() - started
+            print(f"graph: bulk query {loaded:.2f}s + build {built:.2f}s")
+            # memory of a second build, traced separately (tracemalloc slows the build down a lot)
+            graph = None
+            tracemalloc.start()
+            graph = ReferralGraph()
+            graph.build(rows)
+            del rows
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"graph memory: traced {current / 2**20:.1f} MB (build peak {peak / 2**20:.1f} MB), "
+                  f"estimate {graph.memory_bytes() / 2**20:.1f} MB")
+
+            print(f"ancestors ({args.roots} users):")
+            started = time.perf_counter()
+            expected = [await sql_ancestors(conn, tid) for tid in sample]
+            report("sqlite per hop", time.perf_counter() - started, args.roots)
+            started = time.perf_counter()
+            got = [graph.ancestors(tid) for tid in sample]
+            report("ReferralGraph", time.perf_counter() - started, args.roots)
+            assert got == expected
+
+            print(f"subtree to depth {args.depth} ({args.roots} roots):")
+            started = time.perf_counter()
+            expected = [await sql_subtree(conn, tid, args.depth) for tid in sample]
+            report("sqlite per level", time.perf_counter() - started, args.roots)
+            started = time.perf_counter()
+            got = [graph.levels(tid, args.depth) for tid in sample]
+            report("ReferralGraph", time.perf_counter() - started, args.roots)
+            assert got == expected
+
+            started = time.perf_counter()
+            for i in range(10_000):
+                graph.add(20_000_000 + i, sample[i % len(sample)])
+            print(f"append 10k users: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+            # folding the overflow back into CSR: blocking rebuild vs compact_async() in event-loop steps
+            started = time.perf_counter()
+            graph.compact()
+            print(f"compact() blocking: {(time.perf_counter() - started) * 1000:.1f} ms")
+            for i in range(10_000, 10_000 + len(graph) // 10):
+                graph.add(20_000_000 + i, 10_000_000 + i % args.users)
+            overflow = graph._extra_count
+            steps = []
+            task = asyncio.create_task(graph.compact_async())
+            started = time.perf_counter()
+            while not task.done():
+                step = time.perf_counter()
+                await asyncio.sleep(0)
+                steps.append(time.perf_counter() - step)
+            print(f"compact_async() of {overflow} overflow children: total {(time.perf_counter() - started) * 1000:.1f} ms "
+                  f"in {len(steps)} steps, longest loop stall {max(steps) * 1000:.1f} ms")
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
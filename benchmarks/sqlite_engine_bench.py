@@ -0,0 +1,79 @@
+"""
+Commit throughput of the default aiosqlite engine vs sqlite_engine.create_engine_for().
+
+    python benchmarks/sqlite_engine_bench.py [--writers 8] [--commits 200] [--readers 4]
+
+Each writer runs small INSERT + COMMIT transactions (like add_user / withdraw requests),
+readers run point SELECTs at the same time. Prints commits/sec and "database is locked" errors.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from sqlite_engine import create_engine_for
+
+
+async def run(engine, writers: int, commits: int, readers: int):
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE IF NOT EXISTS bench (id INTEGER PRIMARY KEY, user_id INTEGER, amount INTEGER)"))
+    locked = 0
+    done = asyncio.Event()
+
+    async def writer(w: int):
+        nonlocal locked
+        for i in range(commits):
+            try:
+                async with engine.begin() as conn:
+                    await conn.execute(text("INSERT INTO bench (user_id, amount) VALUES (:u, :a)"), {"u": w, "a": i})
+            except OperationalError:
+                locked += 1
+
+    async def reader():
+        nonlocal locked
+        while not done.is_set():
+            try:
+                async with engine.connect() as conn:
+                    await conn.execute(text("SELECT count(*) FROM bench WHERE user_id = 1"))
+            except OperationalError:
+                locked += 1
+            await asyncio.sleep(0)
+
+    reader_tasks = [asyncio.create_task(reader()) for _ in range(readers)]
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(w) for w in range(writers)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await asyncio.gather(*reader_tasks)
+    await engine.dispose()
+    return writers * commits - locked, elapsed, locked
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--commits", type=int, default=200)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        profiles = [
+            ("default", lambda url: create_async_engine(url)),
+            ("tuned", lambda url: create_engine_for(url)),
+        ]
+        for name, factory in profiles:
+            url = f"sqlite+aiosqlite:///{os.path.join(tmp, name + '.db')}"
+            ok, elapsed, locked = await run(factory(url), args.writers, args.commits, args.readers)
+            print(f"{name:8s} commits={ok:6d} time={elapsed:7.2f}s  commits/s={ok / elapsed:9.1f}  locked_errors={locked}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
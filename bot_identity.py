@@ -0,0 +1,48 @@
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.types import User
+
+logger = logging.getLogger("bot_identity")
+
+
+class BotIdentityCache:
+    """
+    Bot's own identity (get_me) fetched once at startup and shared by all handlers.
+    Refreshed lazily after `ttl` seconds; if the refresh fails the last known value is kept.
+    """
+
+    def __init__(self, bot: Bot, ttl: float = 6 * 3600):
+        self.bot = bot
+        self.ttl = ttl
+        self._me: Optional[User] = None
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def set(self, me: User) -> None:
+        self._me = me
+        self._fetched_at = time.monotonic()
+
+    def _fresh(self) -> bool:
+        return self._me is not None and time.monotonic() - self._fetched_at < self.ttl
+
+    async def get(self) -> User:
+        if self._fresh():
+            return self._me
+        async with self._lock:
+            if self._fresh():
+                return self._me
+            try:
+                self.set(await self.bot.get_me())
+            except Exception:
+                if self._me is None:
+                    raise
+                logger.warning("get_me() refresh failed, using cached bot identity", exc_info=True)
+                self._fetched_at = time.monotonic()
+        return self._me
+
+    async def username(self) -> str:
+        return (await self.get()).username
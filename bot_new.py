@@ -14,7 +14,8 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from bot_new_error import ErrorReporterMiddleware,StartStopNotifyMiddleware
 from sqlalchemy import Column, Integer, String, select, func
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlite_engine import create_engine_for
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 #===local==settings===
@@ -53,7 +54,7 @@ dp.startup.register(start_stop_mw.startup)
 dp.shutdown.register(start_stop_mw.shutdown)
 # ======= SQLAlchemy setup =======
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=False)
+engine = create_engine_for(DATABASE_URL, echo=False)
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False) # type: ignore
 
 # ======= Router =======
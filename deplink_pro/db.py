@@ -1,12 +1,16 @@
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
 from dotenv import load_dotenv
 
+# the tuned SQLite engine factory lives in the repository root, shared with the other bots;
+# run this bot as a package from there: python -m deplink_pro.main
+from sqlite_engine import create_engine_for
+
 load_dotenv()
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///bot_data.db")
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot_data.db"))
+engine = create_engine_for(DATABASE_URL, echo=False, future=True)
 AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
 Base = declarative_base()
 
@@ -7,9 +7,9 @@ from aiogram.utils.deep_linking import create_start_link, decode_payload
 from aiogram.types import FSInputFile
 from sqlalchemy import select
 import json
-from db import AsyncSessionLocal
-from models import OrderLink
-from utils import make_token, encode_payload, decode_payload, generate_qr_image
+from .db import AsyncSessionLocal
+from .models import OrderLink
+from .utils import make_token, encode_payload, decode_payload, generate_qr_image
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -2,8 +2,8 @@ import os, asyncio
 from aiogram import Bot, Dispatcher
 from aiogram.filters import Command, CommandStart
 from dotenv import load_dotenv
-from db import init_db
-from handlers import handle_generate, handle_start, handle_stats, handle_qr
+from .db import init_db
+from .handlers import handle_generate, handle_start, handle_stats, handle_qr
 
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -1,6 +1,6 @@
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, Text 
 from sqlalchemy.sql import expression
-from db import Base
+from .db import Base
 from sqlalchemy.dialects.sqlite import DATETIME
 
 class OrderLink(Base):
@@ -15,7 +15,7 @@ else:
     QRLogoType = str | None
 
 load_dotenv()
-QR_FOLDER = os.getenv("QR_FOLDER", "qr_codes")
+QR_FOLDER = os.getenv("QR_FOLDER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "qr_codes"))
 Path(QR_FOLDER).mkdir(parents=True, exist_ok=True)
 
 def make_token() -> str:
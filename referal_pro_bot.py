@@ -1,11 +1,22 @@
 import os
 import sys
 import asyncio
-import io
 import csv
 import tempfile
-from datetime import datetime
-from typing import Optional, List
+import bisect
+import heapq
+import math
+import time
+from collections import OrderedDict
+import gzip
+import html
+import json
+from xml.sax.saxutils import escape as xml_escape, quoteattr
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional, List, Dict, Set, Tuple, NamedTuple, Any, Awaitable, Callable
 
 # Windows asyncio policy fix
 if sys.platform.startswith("win"):
@@ -15,25 +26,26 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Aiogram
-from aiogram import Bot, Dispatcher, types, F, Router
+from aiogram import Bot, Dispatcher, types, F, Router, BaseMiddleware
 from aiogram.filters import Command, CommandStart
 from aiogram.client.default import DefaultBotProperties # type: ignore
-from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, BotCommandScopeChat
+from aiogram.types import Message, FSInputFile, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, BotCommandScopeChat
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.exceptions import TelegramUnauthorizedError
+from aiogram.exceptions import TelegramUnauthorizedError, TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
 from aiogram.enums import ParseMode
+from bot_identity import BotIdentityCache
+from sqlite_engine import create_engine_for
+from referral_graph import ReferralGraph
+import tree_render
 
 # SQLAlchemy async
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, select, func
+from sqlalchemy import inspect as sa_inspect, exists, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Index, select, func, insert, update, delete, literal, case, cast, and_, or_
 
-# Graphviz (we'll use /treeimg in later parts)
-try:
-    from graphviz import Digraph
-    GRAPHVIZ_AVAILABLE = True
-except Exception:
-    GRAPHVIZ_AVAILABLE = False
+# Graphviz (/treeimg; the rendering itself lives in tree_render.py)
+GRAPHVIZ_AVAILABLE = tree_render.GRAPHVIZ_AVAILABLE
 
 # Logging
 import logging
@@ -51,17 +63,99 @@ ALL_OWNER_IDS = [OWNER_ID] + ADDITIONAL_ADMINS
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///referrals.db")
 
-# referral rewards config (can be changed by editing constants)
-LEVEL_REWARDS = {1: 100.0, 2: 50.0, 3: 25.0, 4: 10.0, 5: 5.0}
+def parse_level_rewards(spec: str) -> Dict[int, float]:
+    """`1:100,2:50,3:25` -> {1: 100.0, 2: 50.0, 3: 25.0}. Raises ValueError on bad input (also inf/nan)."""
+    rewards: Dict[int, float] = {}
+    for part in spec.replace(",", " ").split():
+        level, sep, amount = part.partition(":")
+        if not sep or int(level) < 1 or not math.isfinite(float(amount)) or float(amount) < 0:
+            raise ValueError(part)
+        rewards[int(level)] = float(amount)
+    return rewards
+
+# referral rewards config (LEVEL_REWARDS="1:100,2:50,..." env); a table saved by /recompute_rewards apply
+# in bot_settings overrides it at startup (load_level_rewards)
+LEVEL_REWARDS = parse_level_rewards(os.getenv("LEVEL_REWARDS", "")) or {1: 100.0, 2: 50.0, 3: 25.0, 4: 10.0, 5: 5.0}
 MAX_REWARD_LEVEL = max(LEVEL_REWARDS.keys())
 
+# money is stored as integer minor units (1/100) in the ledger
+MINOR_UNITS = 100
+# ledger types that count as earned referral bonus; bonus_adjustment rows (signed) come from /recompute_rewards
+BONUS_TYPES = ("bonus", "bonus_adjustment")
+# how often the background compactor folds new ledger rows into balance_snapshots (seconds)
+LEDGER_COMPACT_INTERVAL = int(os.getenv("LEDGER_COMPACT_INTERVAL", "300"))
+
 MAX_TREE_DEPTH = int(os.getenv("MAX_TREE_DEPTH", "10"))
 
+# cached bot identity (get_me) is refreshed after this many seconds
+BOT_ME_TTL = int(os.getenv("BOT_ME_TTL", str(6 * 3600)))
+
+# max ids per "IN (...)" clause (SQLite host parameter limit is 999 on old builds)
+IN_CHUNK_SIZE = 500
+
+# read-through cache of user rows + balance for /me, /balance, /withdraw
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+# /transactions history page size
+TX_HISTORY_PER_PAGE = 15
+
+# withdraw requests are sent to owners as one digest per window (seconds) or per N requests
+WITHDRAW_DIGEST_WINDOW = float(os.getenv("WITHDRAW_DIGEST_WINDOW", "60"))
+WITHDRAW_DIGEST_MAX = int(os.getenv("WITHDRAW_DIGEST_MAX", "20"))
+# pending withdraws: re-sent to owners after ESCALATE hours, expired after EXPIRE hours (0 = never)
+WITHDRAW_ESCALATE_AFTER = float(os.getenv("WITHDRAW_ESCALATE_AFTER", "24"))
+WITHDRAW_EXPIRE_AFTER = float(os.getenv("WITHDRAW_EXPIRE_AFTER", "72"))
+WITHDRAW_EXPIRY_BATCH = int(os.getenv("WITHDRAW_EXPIRY_BATCH", "100"))
+
+# CSV exports stream rows from the DB in chunks of this size
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# /import_users: rows per INSERT batch and how often (seconds) the progress message is edited
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", "3"))
+# /recompute_rewards: users per keyset chunk
+RECOMPUTE_CHUNK_SIZE = int(os.getenv("RECOMPUTE_CHUNK_SIZE", "5000"))
+
+# user notifications (withdraw results etc.) go through one queue at this rate (msg/s)
+USER_NOTIFY_RATE = float(os.getenv("USER_NOTIFY_RATE", "20"))
+# /withdraw_requests: how many pending requests get a selection button
+WITHDRAW_SELECT_MAX = 30
+
+# incoming update throttling (token buckets): per user and for the whole bot; owners are exempt
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "1"))      # tokens per second
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))
+THROTTLE_GLOBAL_RATE = float(os.getenv("THROTTLE_GLOBAL_RATE", "50"))
+THROTTLE_GLOBAL_BURST = float(os.getenv("THROTTLE_GLOBAL_BURST", "100"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))   # LRU bound on per-user buckets
+THROTTLE_NOTICE_INTERVAL = 60  # seconds between "slow down" replies to the same user
+
+# /broadcast: global send rate (Telegram allows ~30 msg/s per bot), concurrent senders and
+# recipients per checkpoint batch (at most one batch is re-sent after a crash)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))
+
+# /tree: page size (chars inside <pre>), size above which the tree goes out as a .txt document,
+# and how many roots keep their rendered text cached
+TREE_PAGE_CHARS = int(os.getenv("TREE_PAGE_CHARS", "3500"))
+TREE_DOCUMENT_THRESHOLD = int(os.getenv("TREE_DOCUMENT_THRESHOLD", "40000"))
+TREE_TEXT_CACHE_SIZE = int(os.getenv("TREE_TEXT_CACHE_SIZE", "256"))
+
+# /treeimg: Graphviz runs in a process pool, at most TREEIMG_WORKERS renders at a time;
+# file_ids of the last TREEIMG_CACHE_SIZE roots are kept for re-sending
+TREEIMG_WORKERS = int(os.getenv("TREEIMG_WORKERS", "2"))
+TREEIMG_CACHE_SIZE = int(os.getenv("TREEIMG_CACHE_SIZE", "256"))
+# how many recently changed roots keep their own subtree version (older ones share a floor)
+SUBTREE_VERSIONS_SIZE = int(os.getenv("SUBTREE_VERSIONS_SIZE", "100000"))
+
 # -----------------------
 # DB SETUP
 # -----------------------
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+engine = create_engine_for(DATABASE_URL, echo=False, future=True)
 AsyncSessionMaker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 class User(Base):
@@ -72,9 +166,11 @@ class User(Base):
     first_name = Column(String, nullable=True)
     referrer_telegram_id = Column(Integer, nullable=True)
     role = Column(String, default="guest", nullable=False)
-    balance = Column(Float, default=0.0)
+    balance = Column(Float, default=0.0)  # legacy; moved into the ledger by migrate_legacy_balances and no longer written
     referrals_count = Column(Integer, default=0)
+    downline_total = Column(Integer, default=0, nullable=False)
     blocked = Column(Boolean, default=False)
+    bot_blocked = Column(Boolean, default=False, nullable=False)  # user blocked the bot (Forbidden on send); reset on /start
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class message(Base):
@@ -91,13 +187,84 @@ class Transaction(Base):
     id = Column(Integer, primary_key=True)
     user_telegram_id = Column(Integer, nullable=False)
     amount = Column(Float, nullable=False)
-    type = Column(String, default="withdraw")  # withdraw, bonus, manual
+    # signed balance effect in minor units; the row counts towards the balance only while status == "approved"
+    amount_minor = Column(Integer, nullable=True)
+    type = Column(String, default="withdraw")  # withdraw, bonus, bonus_adjustment, manual, opening
     method = Column(String, default="manual")   # payme/qiwi/bank/manual/system
-    status = Column(String, default="pending")  # pending/approved/declined
+    status = Column(String, default="pending")  # pending/approved/declined/expired
     created_at = Column(DateTime, default=datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
+    escalated_at = Column(DateTime, nullable=True)  # pending withdraw re-sent to owners by the expiry scheduler
     admin_telegram_id = Column(Integer, nullable=True)
     note = Column(String, nullable=True)
+    __table_args__ = (
+        Index("ix_transactions_user_id", "user_telegram_id", "id"),
+        Index("ix_transactions_user_created", "user_telegram_id", "created_at"),
+        Index("ix_transactions_type_status_created", "type", "status", "created_at"),
+    )
+
+class BalanceSnapshot(Base):
+    """
+    Folded ledger balance per user: every transactions row with id <= last_tx_id is included
+    in balance_minor. The compactor never moves last_tx_id past the user's oldest pending row,
+    so rows that can still change status always stay in the tail.
+    """
+    __tablename__ = "balance_snapshots"
+    user_telegram_id = Column(Integer, primary_key=True)
+    balance_minor = Column(Integer, default=0, nullable=False)
+    last_tx_id = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ReferralClosure(Base):
+    """
+    Closure table of the referral graph: one row per (ancestor, descendant) pair,
+    including the depth-0 self row of every user. Lets /downline and depth-limited
+    counts run as a single indexed aggregate instead of a BFS.
+    """
+    __tablename__ = "referral_closure"
+    ancestor_telegram_id = Column(Integer, primary_key=True)
+    descendant_telegram_id = Column(Integer, primary_key=True)
+    depth = Column(Integer, nullable=False)
+    __table_args__ = (
+        Index("ix_referral_closure_ancestor_depth", "ancestor_telegram_id", "depth"),
+        Index("ix_referral_closure_descendant_depth", "descendant_telegram_id", "depth"),
+    )
+
+class DownlineCounter(Base):
+    """Denormalized per-level downline size: how many users sit `depth` levels below user_telegram_id."""
+    __tablename__ = "downline_counters"
+    user_telegram_id = Column(Integer, primary_key=True)
+    depth = Column(Integer, primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+class BotSetting(Base):
+    """Runtime settings changed from the bot that must survive restarts (e.g. the applied reward table)."""
+    __tablename__ = "bot_settings"
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class Broadcast(Base):
+    """
+    One mass mailing. Recipients are walked in users.telegram_id order and last_telegram_id is the
+    checkpoint: everyone up to it has been handled, so a "running" broadcast resumes after restart.
+    """
+    __tablename__ = "broadcasts"
+    id = Column(Integer, primary_key=True)
+    admin_telegram_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=True)
+    # or copy an existing message
+    source_chat_id = Column(Integer, nullable=True)
+    source_message_id = Column(Integer, nullable=True)
+    role = Column(String, nullable=True)  # only users with this role; None = everyone
+    include_blocked = Column(Boolean, default=False, nullable=False)
+    status = Column(String, default="running")  # running/done/cancelled/failed
+    last_telegram_id = Column(Integer, default=0, nullable=False)
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    bot_blocked = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
 
 # -----------------------
 # BOT SETUP - TO'G'RILANGAN
@@ -112,6 +279,7 @@ try:
     dp = Dispatcher(storage=storage)
     router = Router()
     dp.include_router(router)
+    bot_identity = BotIdentityCache(bot, ttl=BOT_ME_TTL)
     logger.info("Bot va Dispatcher muvaffaqiyatli yaratildi")
 except Exception as e:
     logger.error(f"Bot yaratishda xato: {e}")
@@ -120,15 +288,299 @@ except Exception as e:
 # -----------------------
 # DB helpers
 # -----------------------
+def _upgrade_existing_tables(sync_conn):
+    """
+    create_all() never alters existing tables, so new model columns (SQLite-friendly
+    ALTER TABLE ADD COLUMN) and new indexes are added here.
+    """
+    insp = sa_inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(sync_conn.dialect)}"
+            if col.default is not None and col.default.is_scalar:
+                ddl += f" NOT NULL DEFAULT {col.default.arg!r}" if not col.nullable else f" DEFAULT {col.default.arg!r}"
+            sync_conn.exec_driver_sql(ddl)
+            logger.info("Added column %s.%s", table.name, col.name)
+        existing_indexes = {i["name"] for i in insp.get_indexes(table.name)}
+        for idx in table.indexes:
+            if idx.name not in existing_indexes:
+                idx.create(sync_conn)
+                logger.info("Created index %s", idx.name)
+
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_upgrade_existing_tables)
     logger.info("Database created / ready.")
 
 async def get_user_by_tid(session: AsyncSession, tid: int) -> Optional[User]:
     res = await session.execute(select(User).where(User.telegram_id == tid))
     return res.scalar_one_or_none()
 
+# -----------------------
+# User cache: bounded LRU + TTL of what /me, /balance and /withdraw read, keyed by telegram_id.
+# Every write path that changes a cached field invalidates the affected ids.
+# -----------------------
+class UserProfile(NamedTuple):
+    user: Optional[User]
+    balance_minor: int
+    levels: Dict[int, int]
+
+class UserCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, Tuple[float, UserProfile]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tid: int) -> Optional[UserProfile]:
+        item = self._data.get(tid)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            if item is not None:
+                del self._data[tid]
+            self.misses += 1
+            return None
+        self._data.move_to_end(tid)
+        self.hits += 1
+        return item[1]
+
+    def put(self, tid: int, profile: UserProfile) -> None:
+        self._data[tid] = (time.monotonic(), profile)
+        self._data.move_to_end(tid)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *tids: int) -> None:
+        for tid in tids:
+            self._data.pop(tid, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / total) if total else 0.0}
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def get_user_profile(tid: int) -> UserProfile:
+    """Read-through: user row, ledger balance and per-level downline counts (also caches "not registered")."""
+    profile = user_cache.get(tid)
+    if profile is not None:
+        return profile
+    async with AsyncSessionMaker() as session:
+        u = await get_user_by_tid(session, tid)
+        if u:
+            profile = UserProfile(u, await get_balance_minor(session, tid), await get_level_counts(session, tid, MAX_REWARD_LEVEL))
+        else:
+            profile = UserProfile(None, 0, {})
+    user_cache.put(tid, profile)
+    return profile
+
+async def insert_closure_rows(session: AsyncSession, telegram_id: int, referrer_tid: Optional[int] = None):
+    """
+    Links a new user into referral_closure: its own depth-0 row plus one row per ancestor
+    of the referrer (copied from the referrer's rows with depth + 1).
+    """
+    await session.execute(insert(ReferralClosure).values(ancestor_telegram_id=telegram_id, descendant_telegram_id=telegram_id, depth=0))
+    if referrer_tid:
+        await session.execute(
+            insert(ReferralClosure).from_select(
+                ["ancestor_telegram_id", "descendant_telegram_id", "depth"],
+                select(ReferralClosure.ancestor_telegram_id, literal(telegram_id), ReferralClosure.depth + 1)
+                .where(ReferralClosure.descendant_telegram_id == referrer_tid)
+            )
+        )
+
+# -----------------------
+# In-memory referral graph (parent array + CSR children): loaded with one query at startup and
+# appended to by every user-creating path, so ancestor and subtree walks skip SQLite.
+# -----------------------
+referral_graph = ReferralGraph()
+
+async def load_referral_graph():
+    started = time.perf_counter()
+    rows: List[Tuple[int, Optional[int]]] = []
+    async with AsyncSessionMaker() as session:
+        result = await session.stream(
+            select(User.telegram_id, User.referrer_telegram_id).order_by(User.id).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        async for part in result.partitions():
+            rows.extend(part)
+    referral_graph.build(rows)
+    logger.info("referral graph loaded: %s users, ~%.1f MB, %.2fs",
+                len(referral_graph), referral_graph.memory_bytes() / 2**20, time.perf_counter() - started)
+
+async def get_ancestor_tids(session: AsyncSession, telegram_id: int) -> List[int]:
+    if referral_graph.loaded and telegram_id in referral_graph:
+        return referral_graph.ancestors(telegram_id)
+    res = await session.execute(
+        select(ReferralClosure.ancestor_telegram_id)
+        .where(ReferralClosure.descendant_telegram_id == telegram_id, ReferralClosure.depth > 0)
+        .order_by(ReferralClosure.depth)
+    )
+    return list(res.scalars().all())
+
+# -----------------------
+# Subtree versions: bumped for every ancestor when someone joins (or a balance, role or name
+# shown in the tree changes), so per-root caches (tree image, tree text) know when they are stale.
+# Versions come from one global counter and the map keeps the SUBTREE_VERSIONS_SIZE most recently
+# bumped roots; evicted roots report a floor version taken from the counter at eviction time, newer
+# than anything cached for them before, so eviction can only cause a re-render, never a stale hit.
+# -----------------------
+SUBTREE_VERSIONS: "OrderedDict[int, int]" = OrderedDict()
+_subtree_version_clock = 0
+_subtree_version_floor = 0
+
+def bump_subtree_versions(tids) -> None:
+    global _subtree_version_clock, _subtree_version_floor
+    for tid in tids:
+        _subtree_version_clock += 1
+        SUBTREE_VERSIONS[tid] = _subtree_version_clock
+        SUBTREE_VERSIONS.move_to_end(tid)
+    if len(SUBTREE_VERSIONS) > SUBTREE_VERSIONS_SIZE:
+        while len(SUBTREE_VERSIONS) > SUBTREE_VERSIONS_SIZE:
+            SUBTREE_VERSIONS.popitem(last=False)
+        # a fresh number: above every version the evicted roots had, below every future bump
+        _subtree_version_clock += 1
+        _subtree_version_floor = _subtree_version_clock
+
+def get_subtree_version(tid: int) -> int:
+    return SUBTREE_VERSIONS.get(tid, _subtree_version_floor)
+
+async def touch_subtree(telegram_id: int) -> None:
+    """Marks telegram_id and all of its ancestors as changed."""
+    async with AsyncSessionMaker() as session:
+        ancestors = await get_ancestor_tids(session, telegram_id)
+    bump_subtree_versions([telegram_id] + ancestors)
+
+async def bump_downline_counters(session: AsyncSession, telegram_id: int):
+    """
+    +1 to downline_total and to the per-level counter of every ancestor of a freshly
+    linked telegram_id (its closure rows must already be inserted in this session).
+    """
+    anc = select(ReferralClosure.ancestor_telegram_id).where(
+        ReferralClosure.descendant_telegram_id == telegram_id, ReferralClosure.depth > 0
+    )
+    await session.execute(
+        update(User)
+        .where(User.telegram_id.in_(anc))
+        .values(downline_total=func.coalesce(User.downline_total, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    same_level = exists().where(
+        ReferralClosure.descendant_telegram_id == telegram_id,
+        ReferralClosure.ancestor_telegram_id == DownlineCounter.user_telegram_id,
+        ReferralClosure.depth == DownlineCounter.depth,
+    )
+    await session.execute(
+        update(DownlineCounter).where(same_level).values(count=DownlineCounter.count + 1).execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        insert(DownlineCounter).from_select(
+            ["user_telegram_id", "depth", "count"],
+            select(ReferralClosure.ancestor_telegram_id, ReferralClosure.depth, literal(1)).where(
+                ReferralClosure.descendant_telegram_id == telegram_id,
+                ReferralClosure.depth > 0,
+                ~exists().where(
+                    DownlineCounter.user_telegram_id == ReferralClosure.ancestor_telegram_id,
+                    DownlineCounter.depth == ReferralClosure.depth,
+                ),
+            )
+        )
+    )
+
+async def get_level_counts(session: AsyncSession, telegram_id: int, max_depth: Optional[int] = None) -> Dict[int, int]:
+    q = select(DownlineCounter.depth, DownlineCounter.count).where(DownlineCounter.user_telegram_id == telegram_id)
+    if max_depth is not None:
+        q = q.where(DownlineCounter.depth <= max_depth)
+    res = await session.execute(q.order_by(DownlineCounter.depth))
+    return {depth: count for depth, count in res.all()}
+
+# cached COUNT(*) of users for the admin list; loaded once, then kept current by the create paths
+_users_total: Optional[int] = None
+
+async def get_users_total(session: AsyncSession) -> int:
+    global _users_total
+    if _users_total is None:
+        _users_total = (await session.execute(select(func.count(User.id)))).scalar_one()
+    return _users_total
+
+def note_user_created(n: int = 1) -> None:
+    global _users_total
+    if _users_total is not None:
+        _users_total += n
+
+# -----------------------
+# Leaderboards: kept sorted in memory, seeded once at startup and updated by add_user,
+# so /top never sorts the users table.
+# -----------------------
+class Leaderboard:
+    """Scores by telegram_id plus a (-score, telegram_id) list kept sorted with bisect."""
+
+    def __init__(self):
+        self._scores: Dict[int, int] = {}
+        self._sorted: List[Tuple[int, int]] = []
+
+    def load(self, pairs) -> None:
+        self._scores = {tid: score for tid, score in pairs if score}
+        self._sorted = sorted((-score, tid) for tid, score in self._scores.items())
+
+    def set(self, tid: int, score: int) -> None:
+        old = self._scores.get(tid, 0)
+        if old == score:
+            return
+        if old:
+            i = bisect.bisect_left(self._sorted, (-old, tid))
+            del self._sorted[i]
+        if score:
+            bisect.insort(self._sorted, (-score, tid))
+            self._scores[tid] = score
+        else:
+            self._scores.pop(tid, None)
+
+    def add(self, tid: int, delta: int) -> None:
+        self.set(tid, self._scores.get(tid, 0) + delta)
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        return [(tid, -neg) for neg, tid in self._sorted[:n]]
+
+LEADERBOARDS: Dict[str, Leaderboard] = {
+    "direct": Leaderboard(),
+    "downline": Leaderboard(),
+    "bonus": Leaderboard(),
+}
+
+async def load_leaderboards():
+    """Startup hook (and after bulk changes): seeds the boards with one query each."""
+    async with AsyncSessionMaker() as session:
+        direct = await session.execute(select(User.telegram_id, User.referrals_count).where(User.referrals_count > 0))
+        LEADERBOARDS["direct"].load(direct.all())
+        downline = await session.execute(select(User.telegram_id, User.downline_total).where(User.downline_total > 0))
+        LEADERBOARDS["downline"].load(downline.all())
+        bonus = await session.execute(
+            select(Transaction.user_telegram_id, func.sum(Transaction.amount_minor))
+            .where(Transaction.type.in_(BONUS_TYPES), Transaction.status == "approved")
+            .group_by(Transaction.user_telegram_id)
+        )
+        LEADERBOARDS["bonus"].load(bonus.all())
+    logger.info("leaderboards loaded")
+
+def leaderboards_on_join(ancestors: List[int], bonuses_minor: Dict[int, int]) -> None:
+    if not ancestors:
+        return
+    LEADERBOARDS["direct"].add(ancestors[0], 1)
+    for tid in ancestors:
+        LEADERBOARDS["downline"].add(tid, 1)
+    for tid, amount in bonuses_minor.items():
+        LEADERBOARDS["bonus"].add(tid, amount)
+
 async def add_user(telegram_id: int, username: Optional[str], first_name: Optional[str], referrer_tid: Optional[int] = None) -> bool:
     """
     Adds user if not exists. If referrer provided and exists, distributes level rewards up the chain.
@@ -138,37 +590,51 @@ async def add_user(telegram_id: int, username: Optional[str], first_name: Option
         existing = await get_user_by_tid(session, telegram_id)
         if existing:
             return False
-        user = User(telegram_id=telegram_id, username=username, first_name=first_name, referrer_telegram_id=referrer_tid, role="guest")
-        session.add(user)
-        # rewards distribution
-        if referrer_tid:
+        # only a registered referrer (and never the user himself) becomes the parent in the tree
+        ref = None
+        if referrer_tid and referrer_tid != telegram_id:
             ref = await get_user_by_tid(session, referrer_tid)
-            if ref:
-                ref.referrals_count = (ref.referrals_count or 0) + 1
-                current_ref = ref
-                level = 1
-                while current_ref and level <= MAX_REWARD_LEVEL:
-                    reward = LEVEL_REWARDS.get(level, 0.0)
-                    if reward:
-                        current_ref.balance = (current_ref.balance or 0.0) + float(reward)
-                        tx = Transaction(
-                            user_telegram_id=current_ref.telegram_id,
-                            amount=float(reward),
-                            type="bonus",
-                            method="system",
-                            status="approved",
-                            processed_at=datetime.utcnow(),
-                            admin_telegram_id=OWNER_ID,
-                            note=f"Referral level {level} bonus from new user {telegram_id}"
-                        )
-                        session.add(tx)
-                    if current_ref.referrer_telegram_id:
-                        current_ref = await get_user_by_tid(session, current_ref.referrer_telegram_id)
-                    else:
-                        current_ref = None
-                    level += 1
+        user = User(telegram_id=telegram_id, username=username, first_name=first_name, referrer_telegram_id=ref.telegram_id if ref else None, role="guest")
+        session.add(user)
+        await insert_closure_rows(session, telegram_id, ref.telegram_id if ref else None)
+        if referral_graph.loaded:
+            ancestors = ([ref.telegram_id] + referral_graph.ancestors(ref.telegram_id)) if ref else []
+        else:
+            ancestors = await get_ancestor_tids(session, telegram_id)
+        if ancestors:
+            await bump_downline_counters(session, telegram_id)
+        # rewards distribution: ancestors come ordered by depth, so index 0 is level 1
+        rewards = {}
+        if ref:
+            ref.referrals_count = (ref.referrals_count or 0) + 1
+            for level, anc_tid in enumerate(ancestors[:MAX_REWARD_LEVEL], start=1):
+                reward = float(LEVEL_REWARDS.get(level, 0.0))
+                if reward:
+                    rewards[anc_tid] = (level, reward)
+            if rewards:
+                now = datetime.utcnow()
+                await session.execute(insert(Transaction), [
+                    dict(
+                        user_telegram_id=anc_tid,
+                        amount=reward,
+                        amount_minor=to_minor(reward),
+                        type="bonus",
+                        method="system",
+                        status="approved",
+                        created_at=now,
+                        processed_at=now,
+                        admin_telegram_id=OWNER_ID,
+                        note=f"Referral level {level} bonus from new user {telegram_id}"
+                    )
+                    for anc_tid, (level, reward) in rewards.items()
+                ])
         await session.commit()
-        return True
+    user_cache.invalidate(telegram_id, *ancestors)
+    bump_subtree_versions(ancestors)
+    note_user_created()
+    referral_graph.add(telegram_id, ref.telegram_id if ref else None)
+    leaderboards_on_join(ancestors, {tid: to_minor(r) for tid, (_, r) in rewards.items()})
+    return True
 
 async def set_role(telegram_id: int, role: str):
     async with AsyncSessionMaker() as session:
@@ -176,10 +642,19 @@ async def set_role(telegram_id: int, role: str):
         if not u:
             u = User(telegram_id=telegram_id, role=role, created_at=datetime.utcnow())
             session.add(u)
+            await insert_closure_rows(session, telegram_id)
+            created = True
         else:
             u.role = role
+            created = False
         await session.commit()
-        return u
+    user_cache.invalidate(telegram_id)
+    if created:
+        note_user_created()
+        referral_graph.add(telegram_id)
+    else:
+        await touch_subtree(telegram_id)  # the role colours this node in every ancestor's /treeimg
+    return u
 
 async def block_user(telegram_id: int):
     async with AsyncSessionMaker() as session:
@@ -187,9 +662,16 @@ async def block_user(telegram_id: int):
         if not u:
             u = User(telegram_id=telegram_id, blocked=True)
             session.add(u)
+            await insert_closure_rows(session, telegram_id)
+            created = True
         else:
             u.blocked = True
+            created = False
         await session.commit()
+    user_cache.invalidate(telegram_id)
+    if created:
+        note_user_created()
+        referral_graph.add(telegram_id)
 
 async def unblock_user(telegram_id: int):
     async with AsyncSessionMaker() as session:
@@ -197,6 +679,7 @@ async def unblock_user(telegram_id: int):
         if u:
             u.blocked = False
             await session.commit()
+    user_cache.invalidate(telegram_id)
 
 async def save_message(sender: int, receiver: int, text: str, message_type: str = "text"):
     async with AsyncSessionMaker() as session:
@@ -204,32 +687,381 @@ async def save_message(sender: int, receiver: int, text: str, message_type: str
         session.add(m)
         await session.commit()
 
-async def get_children(telegram_id: int) -> List[User]:
+async def count_downline(telegram_id: int, max_depth: Optional[int] = None) -> int:
+    """Number of descendants of telegram_id (optionally only down to max_depth levels), read from referral_closure."""
+    q = select(func.count()).select_from(ReferralClosure).where(
+        ReferralClosure.ancestor_telegram_id == telegram_id, ReferralClosure.depth > 0
+    )
+    if max_depth is not None:
+        q = q.where(ReferralClosure.depth <= max_depth)
     async with AsyncSessionMaker() as session:
-        res = await session.execute(select(User).where(User.referrer_telegram_id == telegram_id).order_by(User.id))
-        return res.scalars().all()
+        return (await session.execute(q)).scalar_one()
 
-async def count_downline(telegram_id: int) -> int:
-    total = 0
-    queue = [telegram_id]
-    visited = set()
+async def rebuild_referral_closure() -> int:
+    """
+    One-time backfill (or repair) of referral_closure from users.referrer_telegram_id.
+    Works level by level with INSERT ... SELECT, so it needs one statement per tree level.
+    Returns the number of ancestor/descendant pairs (without self rows).
+    """
+    cols = ["ancestor_telegram_id", "descendant_telegram_id", "depth"]
     async with AsyncSessionMaker() as session:
-        while queue:
-            cur = queue.pop(0)
-            if cur in visited:
-                continue
-            visited.add(cur)
-            res = await session.execute(select(User.telegram_id).where(User.referrer_telegram_id == cur))
-            rows = res.scalars().all()
-            for r in rows:
-                total += 1
-                queue.append(r)
+        await session.execute(delete(ReferralClosure))
+        await session.execute(insert(ReferralClosure).from_select(cols, select(User.telegram_id, User.telegram_id, literal(0))))
+        depth = 0
+        while True:
+            res = await session.execute(
+                insert(ReferralClosure).from_select(
+                    cols,
+                    select(ReferralClosure.ancestor_telegram_id, User.telegram_id, ReferralClosure.depth + 1)
+                    .join(User, User.referrer_telegram_id == ReferralClosure.descendant_telegram_id)
+                    # stops legacy self-referrals / cycles from looping forever
+                    .where(ReferralClosure.depth == depth, User.telegram_id != ReferralClosure.ancestor_telegram_id)
+                )
+            )
+            if not res.rowcount:
+                break
+            depth += 1
+        total = (await session.execute(select(func.count()).select_from(ReferralClosure).where(ReferralClosure.depth > 0))).scalar_one()
+        await session.commit()
+    logger.info("referral_closure rebuilt: %s pairs, %s levels", total, depth)
     return total
 
-async def build_tree_text(root_tid: int, max_depth: int = 7) -> str:
+async def ensure_referral_closure():
+    """Startup hook: backfills referral_closure for databases created before it existed."""
+    async with AsyncSessionMaker() as session:
+        has_closure = (await session.execute(select(ReferralClosure.depth).limit(1))).first() is not None
+        has_users = (await session.execute(select(User.id).limit(1))).first() is not None
+    if has_users and not has_closure:
+        logger.info("referral_closure is empty — backfilling from users table...")
+        await rebuild_referral_closure()
+        await rebuild_downline_counters()
+
+async def rebuild_downline_counters(apply: bool = True) -> Dict[str, int]:
+    """
+    Verifies users.downline_total and downline_counters against referral_closure with grouped
+    aggregates and (if apply) rewrites them in bulk. Returns drift stats.
+    """
+    expected_levels = (
+        select(
+            ReferralClosure.ancestor_telegram_id.label("tid"),
+            ReferralClosure.depth.label("depth"),
+            func.count().label("cnt"),
+        )
+        .where(ReferralClosure.depth > 0)
+        .group_by(ReferralClosure.ancestor_telegram_id, ReferralClosure.depth)
+        .subquery()
+    )
+    expected_total = (
+        select(func.count())
+        .where(ReferralClosure.ancestor_telegram_id == User.telegram_id, ReferralClosure.depth > 0)
+        .scalar_subquery()
+    )
+    async with AsyncSessionMaker() as session:
+        users_drift = (await session.execute(
+            select(func.count()).select_from(User).where(func.coalesce(User.downline_total, 0) != expected_total)
+        )).scalar_one()
+        wrong_or_missing = (await session.execute(
+            select(func.count()).select_from(expected_levels).outerjoin(
+                DownlineCounter,
+                (DownlineCounter.user_telegram_id == expected_levels.c.tid) & (DownlineCounter.depth == expected_levels.c.depth),
+            ).where(func.coalesce(DownlineCounter.count, -1) != expected_levels.c.cnt)
+        )).scalar_one()
+        stale = (await session.execute(
+            select(func.count()).select_from(DownlineCounter).where(~exists().where(
+                ReferralClosure.ancestor_telegram_id == DownlineCounter.user_telegram_id,
+                ReferralClosure.depth == DownlineCounter.depth,
+            ))
+        )).scalar_one()
+        if apply and (users_drift or wrong_or_missing or stale):
+            await session.execute(
+                update(User).values(downline_total=expected_total).execution_options(synchronize_session=False)
+            )
+            await session.execute(delete(DownlineCounter))
+            await session.execute(
+                insert(DownlineCounter).from_select(
+                    ["user_telegram_id", "depth", "count"],
+                    select(expected_levels.c.tid, expected_levels.c.depth, expected_levels.c.cnt),
+                )
+            )
+            await session.commit()
+            user_cache.clear()
+            await load_leaderboards()
+    stats = {"users_drift": users_drift, "levels_drift": wrong_or_missing + stale}
+    if stats["users_drift"] or stats["levels_drift"]:
+        logger.warning("downline counters drift: %s (fixed=%s)", stats, apply)
+    return stats
+
+# -----------------------
+# Bulk import: (telegram_id, referrer_id) rows from a CSV, ordered so every referrer is
+# inserted before its referrals, then written level by level with set-based statements.
+# -----------------------
+class ImportRow(NamedTuple):
+    telegram_id: int
+    referrer_tid: Optional[int]
+    username: Optional[str]
+    first_name: Optional[str]
+
+def parse_import_csv(path: str) -> Tuple[List[ImportRow], List[str]]:
+    """
+    Reads `telegram_id,referrer_id[,username[,first_name]]` rows (header optional).
+    Returns valid rows (first occurrence of a telegram_id wins) and human-readable errors.
+    """
+    rows: List[ImportRow] = []
+    errors: List[str] = []
+    seen = set()
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for lineno, rec in enumerate(csv.reader(f), start=1):
+            if not rec or not "".join(rec).strip():
+                continue
+            if lineno == 1 and not rec[0].strip().lstrip("-").isdigit():
+                continue  # header
+            try:
+                tid = int(rec[0])
+                ref = int(rec[1]) if len(rec) > 1 and rec[1].strip() else None
+            except ValueError:
+                errors.append(f"{lineno}: telegram_id/referrer_id son emas")
+                continue
+            if tid <= 0:
+                errors.append(f"{lineno}: noto'g'ri telegram_id {tid}")
+                continue
+            if tid in seen:
+                errors.append(f"{lineno}: {tid} takrorlangan")
+                continue
+            seen.add(tid)
+            username = (rec[2].strip().lstrip("@") or None) if len(rec) > 2 else None
+            first_name = (rec[3].strip() or None) if len(rec) > 3 else None
+            rows.append(ImportRow(tid, ref if ref != tid else None, username, first_name))
+    return rows, errors
+
+def order_import_levels(rows: List[ImportRow], known_tids: set) -> Tuple[List[List[ImportRow]], List[ImportRow]]:
+    """
+    Topological (Kahn) ordering of the imported edges, grouped by level: level 0 holds rows whose
+    referrer is empty, already registered or not in the file (like add_user, an unknown referrer
+    is dropped); each next level only points at the previous ones. Rows left over sit on a cycle.
+    """
+    by_tid = {r.telegram_id: r for r in rows}
+    children: Dict[int, List[ImportRow]] = {}
+    level: List[ImportRow] = []
+    for r in rows:
+        if r.referrer_tid is None or r.referrer_tid not in by_tid:
+            ref = r.referrer_tid if r.referrer_tid in known_tids else None
+            level.append(r._replace(referrer_tid=ref))
+        else:
+            children.setdefault(r.referrer_tid, []).append(r)
+    levels: List[List[ImportRow]] = []
+    placed = 0
+    while level:
+        levels.append(level)
+        placed += len(level)
+        level = [c for r in level for c in children.get(r.telegram_id, ())]
+    if placed == len(rows):
+        return levels, []
+    placed_tids = {r.telegram_id for lvl in levels for r in lvl}
+    return levels, [r for r in rows if r.telegram_id not in placed_tids]
+
+async def add_downline_counts(session: AsyncSession, descendant_tids: List[int]):
+    """
+    Bulk form of bump_downline_counters for many freshly linked users (none an ancestor of another):
+    their new closure rows, grouped by (ancestor, depth), are added to downline_counters and
+    users.downline_total with one grouped UPDATE / INSERT ... SELECT each.
+    """
+    new_rows = and_(ReferralClosure.descendant_telegram_id.in_(descendant_tids), ReferralClosure.depth > 0)
+    await session.execute(
+        update(User)
+        .where(User.telegram_id.in_(select(ReferralClosure.ancestor_telegram_id).where(new_rows)))
+        .values(downline_total=func.coalesce(User.downline_total, 0) + (
+            select(func.count()).where(new_rows, ReferralClosure.ancestor_telegram_id == User.telegram_id).scalar_subquery()
+        ))
+        .execution_options(synchronize_session=False)
+    )
+    same_level = and_(
+        new_rows,
+        ReferralClosure.ancestor_telegram_id == DownlineCounter.user_telegram_id,
+        ReferralClosure.depth == DownlineCounter.depth,
+    )
+    await session.execute(
+        update(DownlineCounter)
+        .where(exists().where(same_level))
+        .values(count=DownlineCounter.count + select(func.count()).where(same_level).scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        insert(DownlineCounter).from_select(
+            ["user_telegram_id", "depth", "count"],
+            select(ReferralClosure.ancestor_telegram_id, ReferralClosure.depth, func.count())
+            .where(new_rows, ~exists().where(
+                DownlineCounter.user_telegram_id == ReferralClosure.ancestor_telegram_id,
+                DownlineCounter.depth == ReferralClosure.depth,
+            ))
+            .group_by(ReferralClosure.ancestor_telegram_id, ReferralClosure.depth)
+        )
+    )
+
+async def import_referral_rows(rows: List[ImportRow], replay_rewards: bool = False, progress=None) -> Dict[str, int]:
+    """
+    Inserts new users in IMPORT_BATCH_SIZE batches in topological order: users, their closure rows
+    (copied from the already inserted referrer) and, if replay_rewards, the LEVEL_REWARDS bonus rows
+    as one INSERT ... SELECT over the closure, and the ancestors' downline counters are bumped by
+    add_downline_counts(). Already registered telegram_ids are skipped, also those that register
+    with /start while the import runs (ON CONFLICT DO NOTHING; only the rows actually inserted get
+    closure rows, counters and rewards). If a batch fails, the import stops there, stats["error"] is
+    set and the already committed batches still get the final fixups below:
+    referrals_count of the referrers and the leaderboards are recomputed in bulk at the end.
+    `progress(done, total)` is awaited after every batch.
+    """
+    known = set()
+    tids = [r.telegram_id for r in rows] + [r.referrer_tid for r in rows if r.referrer_tid]
+    async with AsyncSessionMaker() as session:
+        for i in range(0, len(tids), IN_CHUNK_SIZE):
+            res = await session.execute(select(User.telegram_id).where(User.telegram_id.in_(tids[i:i + IN_CHUNK_SIZE])))
+            known.update(res.scalars().all())
+    new_rows = [r for r in rows if r.telegram_id not in known]
+    levels, cyclic = order_import_levels(new_rows, known)
+    total = sum(len(lvl) for lvl in levels)
+    stats = {"imported": 0, "skipped_existing": len(rows) - len(new_rows), "cyclic": len(cyclic), "bonus_rows": 0}
+    done = 0
+
+    cols = ["ancestor_telegram_id", "descendant_telegram_id", "depth"]
+    reward_minor = case(
+        {level: to_minor(reward) for level, reward in LEVEL_REWARDS.items()}, value=ReferralClosure.depth, else_=0
+    )
+    now = datetime.utcnow()
+    try:
+        for lvl in levels:
+            for i in range(0, len(lvl), IMPORT_BATCH_SIZE):
+                batch = lvl[i:i + IMPORT_BATCH_SIZE]
+                async with AsyncSessionMaker() as session:
+                    res = await session.execute(
+                        sqlite_insert(User).on_conflict_do_nothing(index_elements=["telegram_id"]).returning(User.telegram_id),
+                        [
+                            dict(telegram_id=r.telegram_id, username=r.username, first_name=r.first_name,
+                                 referrer_telegram_id=r.referrer_tid, role="guest", created_at=now)
+                            for r in batch
+                        ],
+                    )
+                    inserted = set(res.scalars().all())
+                    batch_tids = [r.telegram_id for r in batch if r.telegram_id in inserted]
+                    if batch_tids:
+                        await session.execute(sqlite_insert(ReferralClosure).on_conflict_do_nothing(), [
+                            dict(ancestor_telegram_id=tid, descendant_telegram_id=tid, depth=0) for tid in batch_tids
+                        ])
+                    for j in range(0, len(batch_tids), IN_CHUNK_SIZE):
+                        chunk = batch_tids[j:j + IN_CHUNK_SIZE]
+                        await session.execute(
+                            sqlite_insert(ReferralClosure).from_select(
+                                cols,
+                                select(ReferralClosure.ancestor_telegram_id, User.telegram_id, ReferralClosure.depth + 1)
+                                .join(User, User.referrer_telegram_id == ReferralClosure.descendant_telegram_id)
+                                .where(User.telegram_id.in_(chunk))
+                            ).on_conflict_do_nothing()
+                        )
+                        await add_downline_counts(session, chunk)
+                        if replay_rewards:
+                            res = await session.execute(
+                                insert(Transaction).from_select(
+                                    ["user_telegram_id", "amount", "amount_minor", "type", "method", "status",
+                                     "created_at", "processed_at", "admin_telegram_id", "note"],
+                                    select(
+                                        ReferralClosure.ancestor_telegram_id,
+                                        cast(reward_minor, Float) / MINOR_UNITS,
+                                        reward_minor,
+                                        literal("bonus"), literal("system"), literal("approved"),
+                                        literal(now), literal(now), literal(OWNER_ID),
+                                        "Referral level " + cast(ReferralClosure.depth, String)
+                                        + " bonus from new user " + cast(ReferralClosure.descendant_telegram_id, String),
+                                    ).where(
+                                        ReferralClosure.descendant_telegram_id.in_(chunk),
+                                        ReferralClosure.depth.in_([lv for lv, r in LEVEL_REWARDS.items() if r]),
+                                    )
+                                )
+                            )
+                            stats["bonus_rows"] += res.rowcount or 0
+                    await session.commit()
+                for r in batch:
+                    if r.telegram_id in inserted:
+                        referral_graph.add(r.telegram_id, r.referrer_tid)
+                stats["imported"] += len(inserted)
+                stats["skipped_existing"] += len(batch) - len(inserted)
+                done += len(batch)
+                if progress:
+                    await progress(done, total)
+    except Exception as e:
+        logger.exception("bulk import stopped after %s rows", done)
+        stats["error"] = str(e)
+
+    if stats["imported"]:
+        referrers = sorted({r.referrer_tid for lvl in levels for r in lvl if r.referrer_tid})
+        async with AsyncSessionMaker() as session:
+            children = User.__table__.alias("children")
+            for i in range(0, len(referrers), IN_CHUNK_SIZE):
+                chunk = referrers[i:i + IN_CHUNK_SIZE]
+                await session.execute(
+                    update(User)
+                    .where(User.telegram_id.in_(chunk))
+                    .values(referrals_count=select(func.count()).select_from(children)
+                            .where(children.c.referrer_telegram_id == User.telegram_id).scalar_subquery())
+                    .execution_options(synchronize_session=False)
+                )
+            # existing users that got new descendants: their cached trees/profiles are stale now
+            touched = set()
+            existing_refs = [tid for tid in referrers if tid in known]
+            for i in range(0, len(existing_refs), IN_CHUNK_SIZE):
+                res = await session.execute(
+                    select(ReferralClosure.ancestor_telegram_id).distinct()
+                    .where(ReferralClosure.descendant_telegram_id.in_(existing_refs[i:i + IN_CHUNK_SIZE]))
+                )
+                touched.update(res.scalars().all())
+            await session.commit()
+        bump_subtree_versions(touched)
+        note_user_created(stats["imported"])
+        user_cache.clear()
+        await load_leaderboards()
+    logger.info("bulk import finished: %s", stats)
+    return stats
+
+async def load_tree_levels(root_tid: int, max_depth: int) -> Dict[int, List[User]]:
+    """
+    Loads the referral subtree of root_tid. The shape comes from referral_graph; only the
+    User rows are fetched (IN chunks). Without the graph it falls back to one
+    WHERE referrer_telegram_id IN (...) query per depth level.
+    Returns parent telegram_id -> children (ordered by User.id) map.
+    """
+    if referral_graph.loaded:
+        shape = referral_graph.levels(root_tid, max_depth)
+        tids = [tid for kids in shape.values() for tid in kids]
+        users: Dict[int, User] = {}
+        async with AsyncSessionMaker() as session:
+            for i in range(0, len(tids), IN_CHUNK_SIZE):
+                res = await session.execute(select(User).where(User.telegram_id.in_(tids[i:i + IN_CHUNK_SIZE])))
+                users.update({u.telegram_id: u for u in res.scalars()})
+        return {
+            parent: [users[tid] for tid in kids if tid in users]
+            for parent, kids in shape.items()
+        }
+    children_map: Dict[int, List[User]] = {}
+    seen = {root_tid}
+    frontier = [root_tid]
+    async with AsyncSessionMaker() as session:
+        for _ in range(max_depth):
+            next_frontier: List[int] = []
+            for i in range(0, len(frontier), IN_CHUNK_SIZE):
+                chunk = frontier[i:i + IN_CHUNK_SIZE]
+                res = await session.execute(select(User).where(User.referrer_telegram_id.in_(chunk)).order_by(User.id))
+                for child in res.scalars():
+                    if child.telegram_id in seen:
+                        continue
+                    seen.add(child.telegram_id)
+                    children_map.setdefault(child.referrer_telegram_id, []).append(child)
+                    next_frontier.append(child.telegram_id)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+    return children_map
+
+def render_tree_text(root_tid: int, children_map: Dict[int, List[User]], max_depth: int = 7) -> str:
     lines: List[str] = []
-    async def _recurse(tid: int, level: int, prefix: str):
-        children = await get_children(tid)
+    def _recurse(tid: int, level: int, prefix: str):
+        children = children_map.get(tid)
         if not children:
             return
         for idx, child in enumerate(children):
@@ -239,121 +1071,1135 @@ async def build_tree_text(root_tid: int, max_depth: int = 7) -> str:
             lines.append(f"{prefix}{branch}{name} (ID:{child.telegram_id})")
             new_prefix = prefix + ("    " if is_last else "│   ")
             if level + 1 < max_depth:
-                await _recurse(child.telegram_id, level + 1, new_prefix)
-    await _recurse(root_tid, 0, "")
+                _recurse(child.telegram_id, level + 1, new_prefix)
+    _recurse(root_tid, 0, "")
     return "\n".join(lines)
 
+async def build_tree_text(root_tid: int, max_depth: int = 7) -> str:
+    children_map = await load_tree_levels(root_tid, max_depth)
+    return render_tree_text(root_tid, children_map, max_depth)
+
+# -----------------------
+# Ledger: transactions is the append-only source of truth for balances (integer minor units).
+# balance = balance_snapshots row + approved ledger rows after its last_tx_id
+# -----------------------
+def to_minor(amount) -> int:
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def is_valid_amount(amount: float) -> bool:
+    """Positive, finite and small enough for the ledger's INTEGER minor units (user input: /withdraw, payouts)."""
+    return math.isfinite(amount) and 0 < amount * MINOR_UNITS < 2 ** 63
+
+def check_level_rewards(rewards: Dict[int, float]) -> None:
+    """Raises ValueError unless every reward converts to a ledger amount (finite, >= 0, fits an SQLite INTEGER)."""
+    if not rewards:
+        raise ValueError("empty reward table")
+    for level, amount in rewards.items():
+        try:
+            ok = level >= 1 and math.isfinite(amount) and 0 <= to_minor(amount) < 2 ** 63
+        except (ArithmeticError, TypeError, ValueError):
+            ok = False
+        if not ok:
+            raise ValueError(f"{level}:{amount}")
+
+def fmt_tx_amount(tx_type: Optional[str], amount_minor: Optional[int]) -> str:
+    """Amount column of history/exports: unsigned, except bonus adjustments where the sign is the point."""
+    if tx_type == "bonus_adjustment":
+        return f"{'+' if (amount_minor or 0) > 0 else ''}{fmt_minor(amount_minor)}"
+    return fmt_minor(abs(amount_minor or 0))
+
+def fmt_minor(amount_minor: Optional[int]) -> str:
+    amount_minor = amount_minor or 0
+    sign = "-" if amount_minor < 0 else ""
+    whole, frac = divmod(abs(amount_minor), MINOR_UNITS)
+    return f"{sign}{whole}.{frac:02d}"
+
+def balance_minor_expr(user_tid):
+    """SQL expression for the current balance of user_tid (a bound value or a correlated column)."""
+    snap = BalanceSnapshot.__table__.alias("snap")
+    ledger = Transaction.__table__.alias("ledger")
+    snap_balance = select(snap.c.balance_minor).where(snap.c.user_telegram_id == user_tid).scalar_subquery()
+    snap_last = select(snap.c.last_tx_id).where(snap.c.user_telegram_id == user_tid).scalar_subquery()
+    tail = select(func.coalesce(func.sum(ledger.c.amount_minor), 0)).where(
+        ledger.c.user_telegram_id == user_tid,
+        ledger.c.status == "approved",
+        ledger.c.id > func.coalesce(snap_last, 0),
+    ).scalar_subquery()
+    return func.coalesce(snap_balance, 0) + tail
+
+async def get_balance_minor(session: AsyncSession, user_tid: int) -> int:
+    return (await session.execute(select(balance_minor_expr(user_tid)))).scalar_one()
+
+async def get_balances_minor(session: AsyncSession, user_tids: List[int]) -> Dict[int, int]:
+    balances: Dict[int, int] = {}
+    user_tids = list(user_tids)
+    for i in range(0, len(user_tids), IN_CHUNK_SIZE):
+        chunk = user_tids[i:i + IN_CHUNK_SIZE]
+        res = await session.execute(
+            select(User.telegram_id, balance_minor_expr(User.telegram_id)).where(User.telegram_id.in_(chunk))
+        )
+        balances.update({tid: bal for tid, bal in res.all()})
+    return balances
+
+async def compact_balance_snapshots() -> int:
+    """
+    Folds approved ledger rows into balance_snapshots with set-based statements.
+    Each user's watermark stops right before their oldest pending row. Only users that can have
+    something to fold are touched: those with rows newer than the previous pass and those that
+    were held back by a pending row then. Returns updated snapshots.
+    """
+    global _ledger_compacted_upto, _ledger_held_back
+    tx = Transaction.__table__
+    pend = tx.alias("pend")
+    led = tx.alias("led")
+    snap = BalanceSnapshot.__table__
+    updated = 0
+    async with AsyncSessionMaker() as session:
+        max_id = (await session.execute(select(func.max(tx.c.id)))).scalar()
+        if not max_id:
+            return 0
+        new_users = set((await session.execute(
+            select(tx.c.user_telegram_id).where(tx.c.id > _ledger_compacted_upto).distinct()
+        )).scalars().all())
+        # users with new ledger rows but no snapshot yet
+        await session.execute(
+            insert(snap).from_select(
+                ["user_telegram_id", "balance_minor", "last_tx_id"],
+                select(tx.c.user_telegram_id, literal(0), literal(0))
+                .where(tx.c.id > _ledger_compacted_upto, ~exists().where(snap.c.user_telegram_id == tx.c.user_telegram_id))
+                .distinct()
+            )
+        )
+        pending_users = set((await session.execute(
+            select(tx.c.user_telegram_id).where(tx.c.type == "withdraw", tx.c.status == "pending").distinct()
+        )).scalars().all())
+        candidates = sorted(new_users | _ledger_held_back)
+        first_pending = select(func.min(pend.c.id)).where(
+            pend.c.user_telegram_id == snap.c.user_telegram_id, pend.c.status == "pending"
+        ).scalar_subquery()
+        new_last = case((first_pending <= max_id, first_pending - 1), else_=max_id)
+        delta = select(func.coalesce(func.sum(led.c.amount_minor), 0)).where(
+            led.c.user_telegram_id == snap.c.user_telegram_id,
+            led.c.status == "approved",
+            led.c.id > snap.c.last_tx_id,
+            led.c.id <= new_last,
+        ).scalar_subquery()
+        for i in range(0, len(candidates), IN_CHUNK_SIZE):
+            res = await session.execute(
+                update(snap)
+                .where(snap.c.user_telegram_id.in_(candidates[i:i + IN_CHUNK_SIZE]), new_last > snap.c.last_tx_id)
+                .values(balance_minor=snap.c.balance_minor + delta, last_tx_id=new_last, updated_at=datetime.utcnow())
+            )
+            updated += res.rowcount
+        await session.commit()
+    _ledger_compacted_upto = max_id
+    # a pending row resolved before the next pass does not add a new row, so remember who waits on one
+    _ledger_held_back = pending_users
+    return updated
+
+_ledger_compacted_upto = 0
+_ledger_held_back: Set[int] = set()
+
+async def ledger_compactor_loop():
+    while True:
+        try:
+            updated = await compact_balance_snapshots()
+            if updated:
+                logger.info("balance snapshots compacted: %s users", updated)
+        except Exception:
+            logger.exception("ledger compaction failed")
+        await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
+
+async def migrate_legacy_balances():
+    """
+    Startup hook for databases from before the ledger: fills amount_minor on old rows and moves
+    whatever users.balance holds beyond the ledger sum into one "opening" row per user.
+    Afterwards users.balance is zero and this is a no-op.
+    """
+    async with AsyncSessionMaker() as session:
+        needs_minor = (await session.execute(select(Transaction.id).where(Transaction.amount_minor.is_(None)).limit(1))).first()
+        needs_opening = (await session.execute(select(User.id).where(func.coalesce(User.balance, 0.0) != 0).limit(1))).first()
+        if not needs_minor and not needs_opening:
+            return
+        await session.execute(
+            update(Transaction)
+            .where(Transaction.amount_minor.is_(None))
+            .values(amount_minor=cast(func.round(Transaction.amount * MINOR_UNITS), Integer) * case((Transaction.type == "bonus", 1), else_=-1))
+            .execution_options(synchronize_session=False)
+        )
+        ledger_sum = select(func.coalesce(func.sum(Transaction.amount_minor), 0)).where(
+            Transaction.user_telegram_id == User.telegram_id, Transaction.status == "approved"
+        ).scalar_subquery()
+        opening = cast(func.round(func.coalesce(User.balance, 0.0) * MINOR_UNITS), Integer) - ledger_sum
+        now = datetime.utcnow()
+        res = await session.execute(
+            insert(Transaction).from_select(
+                ["user_telegram_id", "amount", "amount_minor", "type", "method", "status", "created_at", "processed_at", "note"],
+                select(
+                    User.telegram_id, func.abs(opening) / float(MINOR_UNITS), opening, literal("opening"), literal("system"),
+                    literal("approved"), literal(now), literal(now), literal("Opening balance (migrated from users.balance)"),
+                ).where(opening != 0)
+            )
+        )
+        await session.execute(update(User).values(balance=0.0).execution_options(synchronize_session=False))
+        await session.commit()
+    user_cache.clear()
+    logger.info("legacy balances migrated into the ledger (%s opening rows)", res.rowcount)
+
+# -----------------------
+# Reward recomputation: what every user should have earned from referral bonuses under a
+# reward table vs. what the ledger holds, walked in keyset chunks of users.
+# -----------------------
+def format_level_rewards(rewards: Dict[int, float]) -> str:
+    return ",".join(f"{level}:{amount:g}" for level, amount in sorted(rewards.items()))
+
+def set_level_rewards(rewards: Dict[int, float]) -> None:
+    global MAX_REWARD_LEVEL
+    LEVEL_REWARDS.clear()
+    LEVEL_REWARDS.update(rewards)
+    MAX_REWARD_LEVEL = max(LEVEL_REWARDS.keys())
+
+async def load_level_rewards():
+    """Startup hook: a reward table applied by /recompute_rewards takes precedence over the env/default one."""
+    async with AsyncSessionMaker() as session:
+        saved = (await session.execute(select(BotSetting.value).where(BotSetting.key == "level_rewards"))).scalar_one_or_none()
+    if saved:
+        try:
+            rewards = parse_level_rewards(saved)
+            check_level_rewards(rewards)
+        except ValueError:
+            logger.error("bad level_rewards in bot_settings ignored: %r", saved)
+            return
+        set_level_rewards(rewards)
+        logger.info("LEVEL_REWARDS loaded from bot_settings: %s", saved)
+
+async def save_level_rewards(rewards: Dict[int, float]) -> None:
+    value = format_level_rewards(rewards)
+    async with AsyncSessionMaker() as session:
+        setting = await session.get(BotSetting, "level_rewards")
+        if setting:
+            setting.value = value
+            setting.updated_at = datetime.utcnow()
+        else:
+            session.add(BotSetting(key="level_rewards", value=value))
+        await session.commit()
+
+def reward_delta_select(rewards: Dict[int, float], after_tid: int, upto_tid: int):
+    """(telegram_id, expected_minor, earned_minor) for users in (after_tid, upto_tid] whose bonus total is off."""
+    levels = {level: to_minor(amount) for level, amount in rewards.items() if amount}
+    expected = select(func.coalesce(func.sum(
+        case(levels, value=ReferralClosure.depth, else_=0) if levels else literal(0)
+    ), 0)).where(
+        ReferralClosure.ancestor_telegram_id == User.telegram_id,
+        ReferralClosure.depth.between(1, max(levels, default=0)),
+    ).scalar_subquery()
+    earned = select(func.coalesce(func.sum(Transaction.amount_minor), 0)).where(
+        Transaction.user_telegram_id == User.telegram_id, Transaction.type.in_(BONUS_TYPES), Transaction.status == "approved"
+    ).scalar_subquery()
+    return (
+        select(User.telegram_id, expected, earned)
+        .where(User.telegram_id > after_tid, User.telegram_id <= upto_tid, expected != earned)
+        .order_by(User.telegram_id)
+    )
+
+async def recompute_rewards(rewards: Dict[int, float], apply: bool = False, csv_path: Optional[str] = None, progress=None) -> Dict[str, int]:
+    """
+    Compares every user's approved bonus (BONUS_TYPES) ledger total with the total the reward table gives for
+    their referral_closure (descendants per level), RECOMPUTE_CHUNK_SIZE users at a time, so memory
+    stays flat no matter how many edges there are. Per-user deltas go to csv_path (if given);
+    with apply=True the table is first saved to bot_settings and made the live LEVEL_REWARDS (so new
+    joins and restarts use it, and an interrupted run can simply be repeated), then each chunk is
+    corrected by one INSERT ... SELECT of signed "bonus_adjustment" rows.
+    `progress(done_users, total_users)` is awaited after every chunk.
+    Raises ValueError (before anything is saved) if an amount is not a valid ledger amount.
+    """
+    check_level_rewards(rewards)
+    if apply:
+        await save_level_rewards(rewards)
+        set_level_rewards(rewards)
+    stats = {"users": 0, "credit_minor": 0, "debit_minor": 0}
+    f = open(csv_path, "w", newline="", encoding="utf-8") if csv_path else None
+    writer = csv.writer(f) if f else None
+    if writer:
+        writer.writerow(["user_telegram_id", "expected", "earned", "delta"])
+    try:
+        async with AsyncSessionMaker() as session:
+            total = await get_users_total(session)
+        done = 0
+        after = -1
+        while True:
+            async with AsyncSessionMaker() as session:
+                tids = (await session.execute(
+                    select(User.telegram_id).where(User.telegram_id > after).order_by(User.telegram_id).limit(RECOMPUTE_CHUNK_SIZE)
+                )).scalars().all()
+                if not tids:
+                    break
+                deltas = reward_delta_select(rewards, after, tids[-1])
+                rows = (await session.execute(deltas)).all()
+                for tid, expected, earned in rows:
+                    delta = expected - earned
+                    stats["users"] += 1
+                    stats["credit_minor" if delta > 0 else "debit_minor"] += abs(delta)
+                    if writer:
+                        writer.writerow([tid, fmt_minor(expected), fmt_minor(earned), fmt_minor(delta)])
+                if apply and rows:
+                    d = deltas.subquery()
+                    delta = d.c[1] - d.c[2]
+                    now = datetime.utcnow()
+                    await session.execute(
+                        insert(Transaction).from_select(
+                            ["user_telegram_id", "amount", "amount_minor", "type", "method", "status",
+                             "created_at", "processed_at", "admin_telegram_id", "note"],
+                            select(
+                                d.c[0], func.abs(delta) / float(MINOR_UNITS), delta, literal("bonus_adjustment"), literal("system"),
+                                literal("approved"), literal(now), literal(now), literal(OWNER_ID),
+                                literal("Referral bonus recomputation adjustment"),
+                            )
+                        )
+                    )
+                    await session.commit()
+            after = tids[-1]
+            done += len(tids)
+            if progress:
+                await progress(done, total)
+    finally:
+        if f:
+            f.close()
+    if apply and stats["users"]:
+        user_cache.clear()
+        TREEIMG_CACHE.clear()
+        await load_leaderboards()
+    logger.info("reward recomputation (%s): %s", "applied" if apply else "dry-run", stats)
+    return stats
+
 # -----------------------
 # Transaction helpers (basic) - will expand in next parts
 # -----------------------
 async def create_withdraw_request(user_tid: int, amount: float, method: str = "manual", note: Optional[str] = None) -> Transaction:
     async with AsyncSessionMaker() as session:
-        tx = Transaction(user_telegram_id=user_tid, amount=float(amount), type="withdraw", method=method, status="pending", note=note)
+        tx = Transaction(user_telegram_id=user_tid, amount=float(amount), amount_minor=-to_minor(amount), type="withdraw", method=method, status="pending", note=note)
         session.add(tx)
         await session.commit()
         await session.refresh(tx)
         return tx
 
-async def list_user_transactions(user_tid: int) -> List[Transaction]:
+async def get_user_transactions_page(user_tid: int, limit: int, cursor_id: Optional[int] = None, direction: str = "n") -> Tuple[List[Transaction], bool]:
+    """
+    Keyset page of a user's history, newest first, on (created_at, id) — served by
+    ix_transactions_user_created. direction "n" = older than the cursor row, "p" = newer.
+    Returns (rows newest first, whether more rows exist in that direction).
+    """
     async with AsyncSessionMaker() as session:
-        res = await session.execute(select(Transaction).where(Transaction.user_telegram_id == user_tid).order_by(Transaction.created_at.desc()))
-        return res.scalars().all()
+        q = select(Transaction).where(Transaction.user_telegram_id == user_tid)
+        if cursor_id is not None:
+            cur = (await session.execute(
+                select(Transaction.created_at).where(Transaction.id == cursor_id, Transaction.user_telegram_id == user_tid)
+            )).scalar_one_or_none()
+            if cur is not None:
+                if direction == "p":
+                    q = q.where(or_(Transaction.created_at > cur, and_(Transaction.created_at == cur, Transaction.id > cursor_id)))
+                else:
+                    q = q.where(or_(Transaction.created_at < cur, and_(Transaction.created_at == cur, Transaction.id < cursor_id)))
+        if direction == "p":
+            q = q.order_by(Transaction.created_at.asc(), Transaction.id.asc())
+        else:
+            q = q.order_by(Transaction.created_at.desc(), Transaction.id.desc())
+        rows = list((await session.execute(q.limit(limit + 1))).scalars().all())
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "p":
+        rows.reverse()
+    return rows, more
 
 async def list_pending_withdrawals() -> List[Transaction]:
     async with AsyncSessionMaker() as session:
         res = await session.execute(select(Transaction).where(Transaction.type == "withdraw", Transaction.status == "pending").order_by(Transaction.created_at.asc()))
         return res.scalars().all()
 
+async def _decline_pending(session: AsyncSession, tx_id: int, admin_tid: int, note_suffix: str) -> bool:
+    """Guarded status flip: only a still-pending row is declined. Returns True if this call declined it."""
+    res = await session.execute(
+        update(Transaction)
+        .where(Transaction.id == tx_id, Transaction.status == "pending")
+        .values(status="declined", processed_at=datetime.utcnow(), admin_telegram_id=admin_tid,
+                note=func.coalesce(Transaction.note, "") + note_suffix)
+        .execution_options(synchronize_session=False)
+    )
+    return res.rowcount == 1
+
 async def process_withdraw(tx_id: int, admin_tid: int, approve: bool, note: Optional[str] = None) -> str:
+    """
+    Approve/decline a pending withdraw with single guarded UPDATEs (status = 'pending' and, for
+    approvals, enough ledger balance), so concurrent confirmations can never double-spend.
+    """
     async with AsyncSessionMaker() as session:
-        res = await session.execute(select(Transaction).where(Transaction.id == tx_id))
-        tx = res.scalar_one_or_none()
+        if approve:
+            suffix = f" | approved by {admin_tid}: {note}" if note else f" | approved by {admin_tid}"
+            res = await session.execute(
+                update(Transaction)
+                .where(
+                    Transaction.id == tx_id,
+                    Transaction.type == "withdraw",
+                    Transaction.status == "pending",
+                    exists().where(User.telegram_id == Transaction.user_telegram_id),
+                    # amount_minor is negative, so this is "balance >= amount"
+                    balance_minor_expr(Transaction.user_telegram_id) + Transaction.amount_minor >= 0,
+                )
+                .values(status="approved", processed_at=datetime.utcnow(), admin_telegram_id=admin_tid,
+                        note=func.coalesce(Transaction.note, "") + suffix)
+                .execution_options(synchronize_session=False)
+            )
+            if res.rowcount == 1:
+                user_tid = (await session.execute(select(Transaction.user_telegram_id).where(Transaction.id == tx_id))).scalar_one()
+                await session.commit()
+                user_cache.invalidate(user_tid)
+                await touch_subtree(user_tid)
+                return "approved"
+        # slow path: find out why the guarded update did not apply (or decline)
+        tx = (await session.execute(select(Transaction).where(Transaction.id == tx_id))).scalar_one_or_none()
         if not tx:
             return "not_found"
         if tx.status != "pending":
             return "already_processed"
         if approve:
-            # check user balance
             u = await get_user_by_tid(session, tx.user_telegram_id)
             if not u:
-                tx.status = "declined"
-                tx.processed_at = datetime.utcnow()
-                tx.admin_telegram_id = admin_tid
-                await session.commit()
-                return "user_not_found"
-            if (u.balance or 0.0) < tx.amount:
-                tx.status = "declined"
-                tx.processed_at = datetime.utcnow()
-                tx.admin_telegram_id = admin_tid
-                tx.note = (tx.note or "") + " | declined: insufficient balance"
-                await session.commit()
-                return "insufficient_balance"
-            # deduct and mark approved
-            u.balance = (u.balance or 0.0) - tx.amount
-            tx.status = "approved"
-            tx.processed_at = datetime.utcnow()
-            tx.admin_telegram_id = admin_tid
-            tx.note = (tx.note or "") + (f" | approved by {admin_tid}: {note}" if note else f" | approved by {admin_tid}")
-            await session.commit()
-            return "approved"
+                result, suffix = "user_not_found", ""
+            else:
+                result, suffix = "insufficient_balance", " | declined: insufficient balance"
         else:
-            tx.status = "declined"
-            tx.processed_at = datetime.utcnow()
-            tx.admin_telegram_id = admin_tid
-            tx.note = (tx.note or "") + (f" | declined by {admin_tid}: {note}" if note else f" | declined by {admin_tid}")
-            await session.commit()
-            return "declined"
+            result = "declined"
+            suffix = f" | declined by {admin_tid}: {note}" if note else f" | declined by {admin_tid}"
+        if not await _decline_pending(session, tx_id, admin_tid, suffix):
+            return "already_processed"
+        await session.commit()
+        return result
 
-# CSV export helper (will be used by admin)
-async def export_withdraws_csv() -> Optional[str]:
-    pending = await list_pending_withdrawals()
-    if not pending:
+async def process_withdraws_batch(tx_ids: List[int], admin_tid: int, note: Optional[str] = None) -> Dict[int, Tuple[str, Optional[int]]]:
+    """
+    Approves many withdraws in one transaction with set-based statements:
+    1. one guarded UPDATE flips every still-pending withdraw of a registered user to approved
+       (on SQLite this also takes the write lock, so balances can't move underneath us);
+    2. balances of the affected users are read in one query; where a user went negative, that
+       user's newest rows of this batch are declined (insufficient balance) until it fits;
+    3. pending rows of unknown users are declined, like process_withdraw does.
+    Returns tx_id -> (result, user_telegram_id) with the same result codes as process_withdraw.
+    """
+    ids = sorted(set(tx_ids))
+    results: Dict[int, Tuple[str, Optional[int]]] = {}
+    if not ids:
+        return results
+    now = datetime.utcnow()
+    approve_suffix = f" | approved by {admin_tid}: {note}" if note else f" | approved by {admin_tid}"
+    async with AsyncSessionMaker() as session:
+        flipped_rows = (await session.execute(
+            update(Transaction)
+            .where(
+                Transaction.id.in_(ids),
+                Transaction.type == "withdraw",
+                Transaction.status == "pending",
+                exists().where(User.telegram_id == Transaction.user_telegram_id),
+            )
+            .values(status="approved", processed_at=now, admin_telegram_id=admin_tid)
+            .returning(Transaction.id, Transaction.user_telegram_id, Transaction.amount_minor)
+            .execution_options(synchronize_session=False)
+        )).all()
+        flipped: Dict[int, List[Tuple[int, int]]] = {}
+        for tx_id, user_tid, amount_minor in flipped_rows:
+            flipped.setdefault(user_tid, []).append((tx_id, amount_minor or 0))
+        flipped_ids = {tx_id for tx_id, _, _ in flipped_rows}
+        rows = (await session.execute(
+            select(Transaction.id, Transaction.user_telegram_id, Transaction.type, Transaction.status)
+            .where(Transaction.id.in_([tx_id for tx_id in ids if tx_id not in flipped_ids]))
+        )).all()
+        unknown_user: List[int] = []
+        for tx_id, user_tid, tx_type, status in rows:
+            if tx_type != "withdraw":
+                results[tx_id] = ("not_found", None)
+            elif status == "pending":
+                unknown_user.append(tx_id)
+                results[tx_id] = ("user_not_found", user_tid)
+            else:
+                results[tx_id] = ("already_processed", user_tid)
+        for tx_id in ids:
+            results.setdefault(tx_id, ("not_found", None))
+
+        balances = await get_balances_minor(session, list(flipped))
+        insufficient: List[int] = []
+        for user_tid, txs in flipped.items():
+            balance = balances.get(user_tid, 0)
+            for tx_id, amount_minor in sorted(txs, reverse=True):
+                if balance >= 0:
+                    results[tx_id] = ("approved", user_tid)
+                    continue
+                balance -= amount_minor  # amount_minor < 0: taking the row back raises the balance
+                insufficient.append(tx_id)
+                results[tx_id] = ("insufficient_balance", user_tid)
+        approved = [tx_id for tx_id, (res, _) in results.items() if res == "approved"]
+        if approved:
+            await session.execute(
+                update(Transaction).where(Transaction.id.in_(approved))
+                .values(note=func.coalesce(Transaction.note, "") + approve_suffix)
+                .execution_options(synchronize_session=False)
+            )
+        if insufficient:
+            await session.execute(
+                update(Transaction).where(Transaction.id.in_(insufficient))
+                .values(status="declined", note=func.coalesce(Transaction.note, "") + " | declined: insufficient balance")
+                .execution_options(synchronize_session=False)
+            )
+        if unknown_user:
+            await session.execute(
+                update(Transaction).where(Transaction.id.in_(unknown_user), Transaction.status == "pending")
+                .values(status="declined", processed_at=now, admin_telegram_id=admin_tid)
+                .execution_options(synchronize_session=False)
+            )
+        await session.commit()
+    approved_users = {user_tid for res, user_tid in results.values() if res == "approved"}
+    if approved_users:
+        user_cache.invalidate(*approved_users)
+        for user_tid in approved_users:
+            await touch_subtree(user_tid)
+    return results
+
+# CSV export helpers (used by admin)
+EXPORT_COLUMNS = ["id", "user_telegram_id", "username", "type", "amount", "method", "status", "created_at", "processed_at", "note"]
+
+async def export_transactions_csv(
+    tx_type: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    user_tid: Optional[int] = None,
+    compress: bool = False,
+) -> Optional[str]:
+    """
+    Streams transactions joined with users (one query) straight into a temp CSV file,
+    EXPORT_CHUNK_SIZE rows at a time, so memory stays constant. date_to is exclusive.
+    Returns the file path, or None when nothing matched.
+    """
+    q = (
+        select(
+            Transaction.id, Transaction.user_telegram_id, User.username, Transaction.type, Transaction.amount_minor,
+            Transaction.method, Transaction.status, Transaction.created_at, Transaction.processed_at, Transaction.note,
+        )
+        .outerjoin(User, User.telegram_id == Transaction.user_telegram_id)
+        .order_by(Transaction.id)
+    )
+    if tx_type:
+        q = q.where(Transaction.type == tx_type)
+    if status:
+        q = q.where(Transaction.status == status)
+    if date_from:
+        q = q.where(Transaction.created_at >= date_from)
+    if date_to:
+        q = q.where(Transaction.created_at < date_to)
+    if user_tid is not None:
+        q = q.where(Transaction.user_telegram_id == user_tid)
+
+    fd, path = tempfile.mkstemp(suffix=".csv.gz" if compress else ".csv")
+    os.close(fd)
+    rows = 0
+    opener = gzip.open if compress else open
+    try:
+        with opener(path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            async with AsyncSessionMaker() as session:
+                result = await session.stream(q.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+                async for chunk in result.partitions(EXPORT_CHUNK_SIZE):
+                    writer.writerows(
+                        [tx_id, tid, username or "", tx_type_, fmt_tx_amount(tx_type_, amount_minor), method, status_,
+                         created_at.strftime("%Y-%m-%d %H:%M:%S") if created_at else "",
+                         processed_at.strftime("%Y-%m-%d %H:%M:%S") if processed_at else "", note or ""]
+                        for tx_id, tid, username, tx_type_, amount_minor, method, status_, created_at, processed_at, note in chunk
+                    )
+                    rows += len(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    if not rows:
+        os.remove(path)
+        return None
+    return path
+
+TREE_EXPORT_FIELDS = ["telegram_id", "parent", "depth", "username", "first_name", "role", "blocked", "referrals_count", "downline_total", "created_at"]
+
+def _graphml_node(rec: Dict) -> str:
+    data = "".join(
+        f'<data key="{k}">{xml_escape(str(v).lower() if isinstance(v, bool) else str(v))}</data>'
+        for k, v in rec.items() if k not in ("telegram_id", "parent") and v is not None
+    )
+    node = f'<node id="n{rec["telegram_id"]}">{data}</node>\n'
+    if rec["parent"] is not None and rec["depth"]:
+        node += f'<edge source="n{rec["parent"]}" target="n{rec["telegram_id"]}"/>\n'
+    return node
+
+async def export_subtree(root_tid: int, fmt: str = "json", max_depth: Optional[int] = None) -> Optional[str]:
+    """
+    Streams the subtree of root_tid (root included) from referral_closure joined with users,
+    level by level (ix_referral_closure_ancestor_depth), through a server-side cursor straight into
+    a gzip file: newline-delimited JSON or GraphML (nodes with their parent edge). Memory stays at
+    one EXPORT_CHUNK_SIZE batch. Returns the file path, or None if root_tid is unknown.
+    """
+    q = (
+        select(
+            User.telegram_id, User.referrer_telegram_id, ReferralClosure.depth, User.username, User.first_name,
+            User.role, User.blocked, User.referrals_count, User.downline_total, User.created_at,
+        )
+        .join(User, User.telegram_id == ReferralClosure.descendant_telegram_id)
+        .where(ReferralClosure.ancestor_telegram_id == root_tid)
+        .order_by(ReferralClosure.depth)
+    )
+    if max_depth is not None:
+        q = q.where(ReferralClosure.depth <= max_depth)
+    graphml = fmt == "graphml"
+    fd, path = tempfile.mkstemp(suffix=".graphml.gz" if graphml else ".ndjson.gz")
+    os.close(fd)
+    rows = 0
+    try:
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            if graphml:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+                for key in TREE_EXPORT_FIELDS[2:]:
+                    kind = "int" if key in ("depth", "referrals_count", "downline_total") else "boolean" if key == "blocked" else "string"
+                    f.write(f'<key id="{key}" for="node" attr.name="{key}" attr.type="{kind}"/>\n')
+                f.write(f'<graph id={quoteattr(f"referrals_{root_tid}")} edgedefault="directed">\n')
+            async with AsyncSessionMaker() as session:
+                result = await session.stream(q.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+                async for chunk in result.partitions(EXPORT_CHUNK_SIZE):
+                    out = []
+                    for row in chunk:
+                        rec = dict(zip(TREE_EXPORT_FIELDS, row))
+                        rec["blocked"] = bool(rec["blocked"])
+                        rec["created_at"] = rec["created_at"].strftime("%Y-%m-%d %H:%M:%S") if rec["created_at"] else None
+                        if not rec["depth"]:
+                            rec["parent"] = None
+                        out.append(_graphml_node(rec) if graphml else json.dumps(rec, ensure_ascii=False) + "\n")
+                    f.write("".join(out))
+                    rows += len(chunk)
+            if graphml:
+                f.write("</graph>\n</graphml>\n")
+    except Exception:
+        os.remove(path)
+        raise
+    if not rows:
+        os.remove(path)
         return None
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["id", "user_telegram_id", "username", "amount", "method", "status", "created_at", "note"])
-    async with AsyncSessionMaker() as session:
-        for tx in pending:
-            res = await session.execute(select(User).where(User.telegram_id == tx.user_telegram_id))
-            user = res.scalar_one_or_none()
-            username = user.username if user else ""
-            writer.writerow([tx.id, tx.user_telegram_id, username, f"{tx.amount:.2f}", tx.method, tx.status, tx.created_at.strftime("%Y-%m-%d %H:%M:%S"), tx.note or ""])
-    csv_bytes = output.getvalue().encode('utf-8')
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".csv")
-    tmp.write(csv_bytes)
-    tmp.flush()
-    tmp.close()
-    return tmp.name
+    return path
+
+async def export_withdraws_csv() -> Optional[str]:
+    return await export_transactions_csv(tx_type="withdraw", status="pending")
 
 async def manual_payout(admin_tid: int, user_tid: int, amount: float, method: str = "manual", note: Optional[str] = None) -> str:
+    """Appends an approved payout row only if the user exists and has enough balance — one guarded INSERT ... SELECT."""
+    amount_minor = to_minor(amount)
+    now = datetime.utcnow()
     async with AsyncSessionMaker() as session:
-        u = await get_user_by_tid(session, user_tid)
-        if not u:
-            return "user_not_found"
-        if (u.balance or 0.0) < amount:
-            return "insufficient_balance"
-        u.balance = (u.balance or 0.0) - amount
-        tx = Transaction(user_telegram_id=user_tid, amount=amount, type="manual", method=method, status="approved", processed_at=datetime.utcnow(), admin_telegram_id=admin_tid, note=note)
-        session.add(tx)
+        res = await session.execute(
+            insert(Transaction).from_select(
+                ["user_telegram_id", "amount", "amount_minor", "type", "method", "status", "created_at", "processed_at", "admin_telegram_id", "note"],
+                select(
+                    literal(user_tid), literal(float(amount)), literal(-amount_minor), literal("manual"), literal(method),
+                    literal("approved"), literal(now), literal(now), literal(admin_tid), literal(note, String),
+                ).where(
+                    exists().where(User.telegram_id == user_tid),
+                    balance_minor_expr(user_tid) >= amount_minor,
+                )
+            )
+        )
+        if res.rowcount != 1:
+            exists_user = (await session.execute(select(User.id).where(User.telegram_id == user_tid))).first()
+            return "insufficient_balance" if exists_user else "user_not_found"
         await session.commit()
-        return "ok"
+    user_cache.invalidate(user_tid)
+    await touch_subtree(user_tid)
+    return "ok"
+
+# -----------------------
+# STARTUP / ERROR HANDLERS
+# -----------------------
+def split_message_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Splits text on line boundaries into chunks Telegram will accept (a single overlong line is hard-cut)."""
+    chunks: List[str] = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def reply_long(message: types.Message, text: str, **kwargs):
+    """message.reply for texts that may exceed the Telegram limit; reply_markup goes on the last part."""
+    parts = split_message_text(text)
+    markup = kwargs.pop("reply_markup", None)
+    for i, part in enumerate(parts):
+        await message.reply(part, reply_markup=markup if i == len(parts) - 1 else None, **kwargs)
+
+async def notify_owners_startup():
+    for owner in ALL_OWNER_IDS:
+        try:
+            await bot.send_message(owner, f"✅ Bot ishga tushdi — {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} (UTC)", disable_notification=True)
+        except Exception:
+            logger.exception("notify owners startup failed")
+
+async def notify_owners_shutdown():
+    for owner in ALL_OWNER_IDS:
+        try:
+            await bot.send_message(owner, f"⚠️ Bot to'xtadi — {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} (UTC)", disable_notification=True)
+        except Exception:
+            logger.exception("notify owners shutdown failed")
+
+# -----------------------
+# Owner notifications: withdraw requests are queued and flushed as one digest per owner
+# -----------------------
+class WithdrawDigest:
+    """
+    Collects new withdraw requests and sends each owner a single digest message with
+    approve/decline buttons per transaction, every `window` seconds or as soon as
+    `max_items` requests are queued. Backs off on RetryAfter.
+    """
+
+    def __init__(self, owner_ids: List[int], window: float, max_items: int, title: str = "💸 Yangi withdraw so'rovlari"):
+        self.owner_ids = owner_ids
+        self.window = window
+        self.max_items = max_items
+        self.title = title
+        self._queue: List[Tuple[int, int, Optional[str], int]] = []
+        self._wakeup = asyncio.Event()
+
+    def add(self, tx_id: int, user_tid: int, username: Optional[str], amount_minor: int) -> None:
+        self._queue.append((tx_id, user_tid, username, amount_minor))
+        if len(self._queue) >= self.max_items:
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("withdraw digest flush failed")
+
+    async def flush(self):
+        while self._queue:
+            batch = self._queue[:self.max_items]
+            del self._queue[:self.max_items]
+            text, kb = self._render(batch)
+            for owner in self.owner_ids:
+                await self._send(owner, text, kb)
+
+    def _render(self, batch):
+        lines = [f"{self.title}: {len(batch)} ta\n"]
+        rows = []
+        for tx_id, user_tid, username, amount_minor in batch:
+            who = f"@{username}" if username else str(user_tid)
+            lines.append(f"TX_ID:{tx_id} | User:{user_tid} ({who}) | {fmt_minor(amount_minor)}")
+            rows.append([
+                InlineKeyboardButton(text=f"✅ #{tx_id}", callback_data=f"wd:ok:{tx_id}"),
+                InlineKeyboardButton(text=f"❌ #{tx_id}", callback_data=f"wd:no:{tx_id}"),
+            ])
+        lines.append("\n/confirm_withdraw <tx_id> yoki /decline_withdraw <tx_id>")
+        return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+    async def _send(self, chat_id: int, text: str, kb: InlineKeyboardMarkup, attempts: int = 5):
+        for _ in range(attempts):
+            try:
+                await bot.send_message(chat_id, text, reply_markup=kb)
+                return
+            except TelegramRetryAfter as e:
+                logger.warning("withdraw digest: RetryAfter %ss for %s", e.retry_after, chat_id)
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                logger.exception("withdraw digest send failed for %s", chat_id)
+                return
+
+withdraw_digest = WithdrawDigest(ALL_OWNER_IDS, WITHDRAW_DIGEST_WINDOW, WITHDRAW_DIGEST_MAX)
+withdraw_escalations = WithdrawDigest(ALL_OWNER_IDS, WITHDRAW_DIGEST_WINDOW, WITHDRAW_DIGEST_MAX, title="⏰ Uzoq kutayotgan withdraw so'rovlari")
+
+# -----------------------
+# Pending-withdraw expiry: a min-heap of (deadline, kind, tx_id) filled once at startup from
+# ix_transactions_type_status_created and then by cmd_withdraw, so nothing rescans the table.
+# Entries of rows that were processed meanwhile are dropped by the guarded UPDATEs.
+# -----------------------
+class WithdrawExpiryScheduler:
+    ESCALATE, EXPIRE = 0, 1
+
+    def __init__(self, escalate_after_h: float, expire_after_h: float, batch_size: int):
+        self.escalate_after = timedelta(hours=escalate_after_h) if escalate_after_h > 0 else None
+        self.expire_after = timedelta(hours=expire_after_h) if expire_after_h > 0 else None
+        self.batch_size = batch_size
+        self._heap: List[Tuple[datetime, int, int]] = []
+        self._wakeup = asyncio.Event()
+
+    def push(self, tx_id: int, created_at: datetime, escalated: bool = False) -> None:
+        head = self._heap[0][0] if self._heap else None
+        if self.escalate_after and not escalated:
+            heapq.heappush(self._heap, (created_at + self.escalate_after, self.ESCALATE, tx_id))
+        if self.expire_after:
+            heapq.heappush(self._heap, (created_at + self.expire_after, self.EXPIRE, tx_id))
+        if self._heap and (head is None or self._heap[0][0] < head):
+            self._wakeup.set()
+
+    async def load(self) -> int:
+        if not (self.escalate_after or self.expire_after):
+            return 0
+        n = 0
+        q = (
+            select(Transaction.id, Transaction.created_at, Transaction.escalated_at)
+            .where(Transaction.type == "withdraw", Transaction.status == "pending")
+            .order_by(Transaction.created_at)
+        )
+        async with AsyncSessionMaker() as session:
+            result = await session.stream(q.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+            async for rows in result.partitions():
+                for tx_id, created_at, escalated_at in rows:
+                    self.push(tx_id, created_at or datetime.utcnow(), escalated=escalated_at is not None)
+                    n += 1
+        logger.info("withdraw expiry: %s pending withdraws scheduled", n)
+        return n
+
+    def _pop_due(self, now: datetime) -> Dict[int, List[int]]:
+        due: Dict[int, List[int]] = {self.ESCALATE: [], self.EXPIRE: []}
+        taken = 0
+        while self._heap and self._heap[0][0] <= now and taken < self.batch_size:
+            _, kind, tx_id = heapq.heappop(self._heap)
+            due[kind].append(tx_id)
+            taken += 1
+        return due
+
+    async def run(self):
+        await self.load()
+        while True:
+            timeout = None
+            if self._heap:
+                timeout = max((self._heap[0][0] - datetime.utcnow()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._heap and self._heap[0][0] <= datetime.utcnow():
+                due = self._pop_due(datetime.utcnow())
+                try:
+                    if due[self.EXPIRE]:
+                        await self.expire(due[self.EXPIRE])
+                    if due[self.ESCALATE]:
+                        await self.escalate(due[self.ESCALATE])
+                except Exception:
+                    logger.exception("withdraw expiry batch failed")
+
+    async def expire(self, tx_ids: List[int]) -> List[Tuple[int, int]]:
+        """Guarded batch flip of still-pending rows to "expired"; users are told. Returns (tx_id, user_tid)."""
+        now = datetime.utcnow()
+        hours = self.expire_after.total_seconds() / 3600 if self.expire_after else 0
+        async with AsyncSessionMaker() as session:
+            res = await session.execute(
+                update(Transaction)
+                .where(Transaction.id.in_(tx_ids), Transaction.type == "withdraw", Transaction.status == "pending")
+                .values(status="expired", processed_at=now,
+                        note=func.coalesce(Transaction.note, "") + f" | expired after {hours:g}h")
+                .returning(Transaction.id, Transaction.user_telegram_id)
+                .execution_options(synchronize_session=False)
+            )
+            expired = [tuple(row) for row in res.all()]
+            await session.commit()
+        for tx_id, user_tid in expired:
+            user_notifier.add(user_tid, f"⌛ Sizning withdraw so'rovingiz (ID:{tx_id}) {hours:g} soat ichida ko'rib chiqilmadi va bekor qilindi. Kerak bo'lsa qaytadan yuboring.")
+        if expired:
+            logger.info("withdraw expiry: %s requests expired", len(expired))
+        return expired
+
+    async def escalate(self, tx_ids: List[int]) -> int:
+        """Marks still-pending rows as escalated (once) and re-sends them to owners via withdraw_escalations."""
+        async with AsyncSessionMaker() as session:
+            res = await session.execute(
+                update(Transaction)
+                .where(Transaction.id.in_(tx_ids), Transaction.status == "pending", Transaction.escalated_at.is_(None))
+                .values(escalated_at=datetime.utcnow())
+                .returning(Transaction.id, Transaction.user_telegram_id, Transaction.amount_minor)
+                .execution_options(synchronize_session=False)
+            )
+            rows = res.all()
+            usernames = {}
+            if rows:
+                usernames = dict((await session.execute(
+                    select(User.telegram_id, User.username).where(User.telegram_id.in_({user_tid for _, user_tid, _ in rows}))
+                )).all())
+            await session.commit()
+        for tx_id, user_tid, amount_minor in rows:
+            withdraw_escalations.add(tx_id, user_tid, usernames.get(user_tid), -(amount_minor or 0))
+        if rows:
+            logger.info("withdraw expiry: %s requests escalated", len(rows))
+        return len(rows)
+
+withdraw_expiry = WithdrawExpiryScheduler(WITHDRAW_ESCALATE_AFTER, WITHDRAW_EXPIRE_AFTER, WITHDRAW_EXPIRY_BATCH)
+
+# -----------------------
+# Broadcast: recipients streamed in keyset batches through a pool of senders sharing one
+# global rate limiter; every recipient gets one message, so the per-chat limit is never hit.
+# -----------------------
+class RateLimiter:
+    """Spaces calls `1 / rate` seconds apart across all callers; pause() holds everyone back (RetryAfter)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+BROADCAST_TASKS: Dict[int, asyncio.Task] = {}
+
+def broadcast_recipients_query(bc: Broadcast, after_tid: int):
+    q = select(User.telegram_id).where(User.telegram_id > after_tid, User.bot_blocked == False)  # noqa: E712
+    if bc.role:
+        q = q.where(User.role == bc.role)
+    if not bc.include_blocked:
+        q = q.where(or_(User.blocked == False, User.blocked.is_(None)))  # noqa: E712
+    return q.order_by(User.telegram_id).limit(BROADCAST_BATCH_SIZE)
+
+# BadRequest descriptions that concern one recipient; any other BadRequest (unparsable HTML, empty or
+# too long text, deleted source message) would fail for everyone and stops the broadcast instead
+BROADCAST_CHAT_ERRORS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated", "chat_restricted", "not enough rights")
+
+def is_chat_specific_error(e: TelegramBadRequest) -> bool:
+    text = (e.message or "").lower()
+    return any(marker in text for marker in BROADCAST_CHAT_ERRORS)
+
+async def _broadcast_send(bc: Broadcast, chat_id: int, limiter: RateLimiter, attempts: int = 3) -> str:
+    """"sent" / "bot_blocked" / "failed"; a BadRequest that is not about this chat is re-raised."""
+    for _ in range(attempts):
+        await limiter.wait()
+        try:
+            if bc.source_message_id:
+                await bot.copy_message(chat_id, bc.source_chat_id, bc.source_message_id)
+            else:
+                await bot.send_message(chat_id, bc.text)
+            return "sent"
+        except TelegramRetryAfter as e:
+            logger.warning("broadcast %s: RetryAfter %ss", bc.id, e.retry_after)
+            limiter.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "bot_blocked"
+        except TelegramBadRequest as e:
+            if not is_chat_specific_error(e):
+                raise
+            logger.info("broadcast %s: send to %s failed: %s", bc.id, chat_id, e)
+            return "failed"
+        except Exception as e:
+            logger.info("broadcast %s: send to %s failed: %s", bc.id, chat_id, e)
+            return "failed"
+    return "failed"
+
+async def run_broadcast(broadcast_id: int):
+    """
+    Sends one broadcast from its checkpoint to the end, committing progress after every batch.
+    A fatal send error (see _broadcast_send) marks it "failed" without moving the checkpoint.
+    """
+    async with AsyncSessionMaker() as session:
+        bc = await session.get(Broadcast, broadcast_id)
+    if not bc or bc.status != "running":
+        return
+    limiter = RateLimiter(BROADCAST_RATE)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+    results: Dict[str, List[int]] = {}
+    fatal: List[Exception] = []
+
+    async def worker():
+        while True:
+            chat_id = await queue.get()
+            try:
+                if not fatal:
+                    results.setdefault(await _broadcast_send(bc, chat_id, limiter), []).append(chat_id)
+            except TelegramBadRequest as e:
+                fatal.append(e)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    try:
+        after = bc.last_telegram_id
+        while True:
+            async with AsyncSessionMaker() as session:
+                tids = (await session.execute(broadcast_recipients_query(bc, after))).scalars().all()
+            if not tids:
+                break
+            results.clear()
+            for tid in tids:
+                if fatal:
+                    break
+                await queue.put(tid)
+            await queue.join()
+            blocked_now = results.get("bot_blocked", [])
+            values = dict(
+                sent=Broadcast.sent + len(results.get("sent", [])),
+                failed=Broadcast.failed + len(results.get("failed", [])),
+                bot_blocked=Broadcast.bot_blocked + len(blocked_now),
+            )
+            if fatal:
+                values.update(status="failed", finished_at=datetime.utcnow())
+            else:
+                after = tids[-1]
+                values["last_telegram_id"] = after
+            async with AsyncSessionMaker() as session:
+                if blocked_now:
+                    await session.execute(
+                        update(User).where(User.telegram_id.in_(blocked_now)).values(bot_blocked=True)
+                        .execution_options(synchronize_session=False)
+                    )
+                await session.execute(update(Broadcast).where(Broadcast.id == bc.id).values(**values))
+                await session.commit()
+            if blocked_now:
+                user_cache.invalidate(*blocked_now)
+            if fatal:
+                logger.error("broadcast %s stopped at checkpoint %s: %s", bc.id, after, fatal[0])
+                try:
+                    await bot.send_message(
+                        bc.admin_telegram_id,
+                        f"⛔ Broadcast #{bc.id} to'xtatildi: {html.escape(str(fatal[0]))}\nCheckpoint: {after}",
+                    )
+                except Exception:
+                    pass
+                return
+        async with AsyncSessionMaker() as session:
+            await session.execute(
+                update(Broadcast).where(Broadcast.id == bc.id, Broadcast.status == "running")
+                .values(status="done", finished_at=datetime.utcnow())
+            )
+            await session.commit()
+            bc = await session.get(Broadcast, broadcast_id)
+        logger.info("broadcast %s finished: sent=%s failed=%s bot_blocked=%s", bc.id, bc.sent, bc.failed, bc.bot_blocked)
+        try:
+            await bot.send_message(
+                bc.admin_telegram_id,
+                f"📣 Broadcast #{bc.id} tugadi\nYuborildi: {bc.sent}\nXato: {bc.failed}\nBotni bloklaganlar: {bc.bot_blocked}",
+            )
+        except Exception:
+            pass
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        BROADCAST_TASKS.pop(broadcast_id, None)
+
+def start_broadcast_task(broadcast_id: int) -> None:
+    BROADCAST_TASKS[broadcast_id] = asyncio.create_task(run_broadcast(broadcast_id))
+
+async def create_broadcast(admin_tid: int, text: Optional[str] = None, source: Optional[Tuple[int, int]] = None,
+                           role: Optional[str] = None, include_blocked: bool = False) -> int:
+    async with AsyncSessionMaker() as session:
+        bc = Broadcast(
+            admin_telegram_id=admin_tid, text=text, role=role, include_blocked=include_blocked,
+            source_chat_id=source[0] if source else None, source_message_id=source[1] if source else None,
+        )
+        session.add(bc)
+        await session.commit()
+    start_broadcast_task(bc.id)
+    return bc.id
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    async with AsyncSessionMaker() as session:
+        res = await session.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == "running")
+            .values(status="cancelled", finished_at=datetime.utcnow())
+        )
+        await session.commit()
+    task = BROADCAST_TASKS.pop(broadcast_id, None)
+    if task:
+        task.cancel()
+    return bool(res.rowcount)
+
+async def resume_broadcasts():
+    """Startup: picks up broadcasts that were still running when the bot stopped."""
+    async with AsyncSessionMaker() as session:
+        ids = (await session.execute(select(Broadcast.id).where(Broadcast.status == "running"))).scalars().all()
+    for broadcast_id in ids:
+        logger.info("resuming broadcast %s", broadcast_id)
+        start_broadcast_task(broadcast_id)
+
+class UserNotifier:
+    """Queue of (chat_id, text) sent by one worker through a RateLimiter; backs off on RetryAfter."""
+
+    def __init__(self, rate: float):
+        self.limiter = RateLimiter(rate)
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def add(self, chat_id: int, text: str) -> None:
+        self._queue.put_nowait((chat_id, text))
 
-# -----------------------
-# STARTUP / ERROR HANDLERS
-# -----------------------
-async def notify_owners_startup():
-    for owner in ALL_OWNER_IDS:
-        try:
-            await bot.send_message(owner, f"✅ Bot ishga tushdi — {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} (UTC)", disable_notification=True)
-        except Exception:
-            logger.exception("notify owners startup failed")
+    async def _send(self, chat_id: int, text: str, attempts: int = 3):
+        for _ in range(attempts):
+            await self.limiter.wait()
+            try:
+                await bot.send_message(chat_id, text)
+                return
+            except TelegramRetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except Exception:
+                return
 
-async def notify_owners_shutdown():
-    for owner in ALL_OWNER_IDS:
-        try:
-            await bot.send_message(owner, f"⚠️ Bot to'xtadi — {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} (UTC)", disable_notification=True)
-        except Exception:
-            logger.exception("notify owners shutdown failed")
+    async def run(self):
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                await self._send(chat_id, text)
+            finally:
+                self._queue.task_done()
+
+    async def flush(self):
+        while not self._queue.empty():
+            chat_id, text = self._queue.get_nowait()
+            await self._send(chat_id, text, attempts=1)
+
+user_notifier = UserNotifier(USER_NOTIFY_RATE)
+
+BACKGROUND_TASKS: List[asyncio.Task] = []
+
+async def start_background_tasks():
+    BACKGROUND_TASKS.append(asyncio.create_task(ledger_compactor_loop()))
+    BACKGROUND_TASKS.append(asyncio.create_task(withdraw_digest.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(withdraw_escalations.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(withdraw_expiry.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(user_notifier.run()))
+    await resume_broadcasts()
+
+async def stop_background_tasks():
+    # broadcasts stay "running" in the DB and resume from their checkpoint on the next start
+    tasks = BACKGROUND_TASKS + list(BROADCAST_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    BROADCAST_TASKS.clear()
+    # don't lose requests still waiting for the next digest
+    await withdraw_digest.flush()
+    await withdraw_escalations.flush()
+    await user_notifier.flush()
 
 # async def error_handler(update: types.Update, exception: Exception):
 #     logger.exception("Error: %s", exception)
@@ -363,6 +2209,82 @@ async def notify_owners_shutdown():
 #         except Exception:
 #             pass
 
+# -----------------------
+# Throttling: outer middleware on the router, so flooded updates are dropped before any
+# filter, handler or DB session runs.
+# -----------------------
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Per-user bucket first (a flooder never drains the global one), then the global bucket."""
+
+    def __init__(self):
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.global_bucket = TokenBucket(THROTTLE_GLOBAL_RATE, THROTTLE_GLOBAL_BURST)
+        self.dropped = {"user": 0, "global": 0}
+        self._noticed: Dict[int, float] = {}
+
+    def _user_bucket(self, uid: int) -> TokenBucket:
+        bucket = self.buckets.get(uid)
+        if bucket is None:
+            bucket = self.buckets[uid] = TokenBucket(THROTTLE_USER_RATE, THROTTLE_USER_BURST)
+            if len(self.buckets) > THROTTLE_MAX_USERS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(uid)
+        return bucket
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or user.id in ALL_OWNER_IDS:
+            return await handler(event, data)
+        if not self._user_bucket(user.id).take():
+            self.dropped["user"] += 1
+            await self._notify(event, user.id)
+            return None
+        if not self.global_bucket.take():
+            self.dropped["global"] += 1
+            return None
+        return await handler(event, data)
+
+    async def _notify(self, event: Any, uid: int):
+        try:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer("⏳ Juda tez! Biroz kuting.")
+                return
+            now = time.monotonic()
+            if now - self._noticed.get(uid, 0.0) < THROTTLE_NOTICE_INTERVAL:
+                return
+            self._noticed[uid] = now
+            if len(self._noticed) > THROTTLE_MAX_USERS:
+                self._noticed.clear()
+            await event.answer("⏳ Juda ko'p so'rov. Iltimos, biroz kuting.")
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"tracked_users": len(self.buckets), **self.dropped}
+
+throttling = ThrottlingMiddleware()
+router.message.outer_middleware(throttling)
+router.callback_query.outer_middleware(throttling)
+
 # -----------------------
 # PUBLIC HANDLERS
 # -----------------------
@@ -374,8 +2296,23 @@ async def cmd_start(message: types.Message):
         a = args[1].strip()
         if a.isdigit():
             ref = int(a)
-    created = await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name, ref)
-    bot_username = (await bot.get_me()).username
+    # repeated /start of a known user is answered from the in-memory graph, without add_user's session
+    if referral_graph.loaded and message.from_user.id in referral_graph:
+        created = False
+    else:
+        created = await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name, ref)
+    if not created:
+        # a user who blocked the bot and came back gets broadcasts again; the flag is read from the
+        # user cache (run_broadcast invalidates it) so a plain repeated /start takes no write lock
+        profile = await get_user_profile(message.from_user.id)
+        if profile.user is not None and profile.user.bot_blocked:
+            async with AsyncSessionMaker() as session:
+                await session.execute(
+                    update(User).where(User.telegram_id == message.from_user.id).values(bot_blocked=False)
+                )
+                await session.commit()
+            user_cache.invalidate(message.from_user.id)
+    bot_username = await bot_identity.username()
     ref_link = f"https://t.me/{bot_username}?start={message.from_user.id}"
     if not created:
         await message.reply(f"Siz allaqachon ro'yxatda bo'lgansiz ✅\nSizning referal link: {ref_link}")
@@ -386,7 +2323,9 @@ async def cmd_start(message: types.Message):
             f"👥 Sizning referal linkingiz:\n{ref_link}\n\n"
             f"🌳 /tree — referal daraxt\n"
             f"🖼 /treeimg — daraxt rasm (agar Graphviz mavjud bo'lsa)\n"
-            f"📊 /downline — avlodlar soni\n"
+            f"📊 /downline [daraja] — avlodlar soni\n"
+            f"📈 /treestats — daraxt statistikasi\n"
+            f"🏆 /top — eng yaxshi referallar\n"
             f"👤 /me — profil va balans\n"
             f"💳 /balance — balansni ko'rish\n"
             f"💸 /withdraw <sum> — yechib olish so'rovi yuborish\n"
@@ -394,13 +2333,122 @@ async def cmd_start(message: types.Message):
         )
         return
 
+# root telegram_id -> (subtree version, tree lines, page bounds), LRU-bounded
+TREE_TEXT_CACHE: "OrderedDict[int, Tuple[int, List[str], List[Tuple[int, int]]]]" = OrderedDict()
+
+def paginate_tree_lines(lines: List[str], budget: int = TREE_PAGE_CHARS) -> List[Tuple[int, int]]:
+    """
+    Splits tree lines into pages of whole top-level subtrees ([start, end) line ranges) that fit
+    `budget` escaped characters; a subtree bigger than one page is cut on line boundaries.
+    """
+    blocks: List[Tuple[int, int]] = []
+    start = 0
+    for i, line in enumerate(lines):
+        if i and line.startswith(("├", "└")):
+            blocks.append((start, i))
+            start = i
+    if lines:
+        blocks.append((start, len(lines)))
+
+    sizes = [len(html.escape(line)) + 1 for line in lines]
+    pages: List[Tuple[int, int]] = []
+    page_start, page_len = None, 0
+    for b_start, b_end in blocks:
+        b_len = sum(sizes[b_start:b_end])
+        if page_start is not None and page_len + b_len > budget:
+            pages.append((page_start, b_start))
+            page_start, page_len = None, 0
+        if b_len <= budget:
+            if page_start is None:
+                page_start = b_start
+            page_len += b_len
+            continue
+        chunk_start, chunk_len = b_start, 0
+        for i in range(b_start, b_end):
+            if chunk_len and chunk_len + sizes[i] > budget:
+                pages.append((chunk_start, i))
+                chunk_start, chunk_len = i, 0
+            chunk_len += sizes[i]
+        pages.append((chunk_start, b_end))
+    if page_start is not None:
+        pages.append((page_start, len(lines)))
+    return pages
+
+async def get_tree_pages(root_tid: int) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """Rendered tree of root_tid, cached until its subtree version changes."""
+    version = get_subtree_version(root_tid)
+    cached = TREE_TEXT_CACHE.get(root_tid)
+    if cached and cached[0] == version:
+        TREE_TEXT_CACHE.move_to_end(root_tid)
+        return cached[1], cached[2]
+    text = await build_tree_text(root_tid, max_depth=MAX_TREE_DEPTH)
+    lines = text.split("\n") if text else []
+    pages = paginate_tree_lines(lines)
+    TREE_TEXT_CACHE[root_tid] = (version, lines, pages)
+    TREE_TEXT_CACHE.move_to_end(root_tid)
+    while len(TREE_TEXT_CACHE) > TREE_TEXT_CACHE_SIZE:
+        TREE_TEXT_CACHE.popitem(last=False)
+    return lines, pages
+
+def render_tree_page(lines: List[str], pages: List[Tuple[int, int]], page: int):
+    page = min(max(page, 0), len(pages) - 1)
+    start, end = pages[page]
+    body = html.escape("\n".join(lines[start:end]))
+    header = "🌳 Sizning referal daraxtingiz"
+    if len(pages) > 1:
+        header += f" ({page + 1}/{len(pages)})"
+    rows = []
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅", callback_data=f"tree:{page - 1}"))
+    if page < len(pages) - 1:
+        nav.append(InlineKeyboardButton(text="➡", callback_data=f"tree:{page + 1}"))
+    if nav:
+        rows.append(nav)
+        rows.append([InlineKeyboardButton(text="📄 Fayl sifatida", callback_data="tree:doc")])
+    return f"{header}:\n\n<pre>{body}</pre>", InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+async def send_tree_document(chat_id: int, root_tid: int, lines: List[str]):
+    data = "\n".join(lines).encode("utf-8")
+    await bot.send_document(chat_id, BufferedInputFile(data, filename=f"tree_{root_tid}.txt"), caption=f"🌳 Referal daraxti ({len(lines)} ta qator)")
+
+async def send_tree(chat_id: int, root_tid: int, reply_to: Optional[types.Message] = None):
+    lines, pages = await get_tree_pages(root_tid)
+    if not lines:
+        return await bot.send_message(chat_id, "Siz hali hech kimni taklif qilmagansiz 🌱")
+    if sum(len(line) + 1 for line in lines) > TREE_DOCUMENT_THRESHOLD:
+        return await send_tree_document(chat_id, root_tid, lines)
+    text, kb = render_tree_page(lines, pages, 0)
+    if reply_to:
+        return await reply_to.reply(text, reply_markup=kb)
+    return await bot.send_message(chat_id, text, reply_markup=kb)
+
 @router.message(Command("tree"))
 async def cmd_tree(message: types.Message):
-    tree = await build_tree_text(message.from_user.id, max_depth=MAX_TREE_DEPTH)
-    if not tree:
-        await message.reply("Siz hali hech kimni taklif qilmagansiz 🌱")
-        return
-    await message.reply(f"🌳 Sizning referal daraxtingiz:\n\n<pre>{tree}</pre>")
+    await send_tree(message.chat.id, message.from_user.id, reply_to=message)
+
+@router.callback_query(F.data == "admin_tree_me")
+async def cb_admin_tree_me(call: types.CallbackQuery):
+    if call.from_user.id not in ALL_OWNER_IDS:
+        return await call.answer("Ruxsat yo'q", show_alert=True)
+    await call.answer()
+    await send_tree(call.message.chat.id, call.from_user.id)
+
+@router.callback_query(F.data.startswith("tree:"))
+async def cb_tree_page(call: types.CallbackQuery):
+    root = call.from_user.id
+    lines, pages = await get_tree_pages(root)
+    if not lines:
+        return await call.answer("Daraxt bo'sh.")
+    if call.data == "tree:doc":
+        await call.answer()
+        return await send_tree_document(call.message.chat.id, root, lines)
+    text, kb = render_tree_page(lines, pages, int(call.data.split(":", 1)[1]))
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await call.answer()
 
 # Graphviz coloring & node info
 ROLE_COLOR = {
@@ -413,81 +2461,209 @@ ROLE_COLOR = {
     "guest": "gray"
 }
 
+_treeimg_pool: Optional[ProcessPoolExecutor] = None
+_treeimg_semaphore = asyncio.Semaphore(TREEIMG_WORKERS)
+# root telegram_id -> (subtree version, Telegram file_id of the uploaded PNG)
+TREEIMG_CACHE: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+
+async def render_tree_png(nodes: List[Tuple[int, str, str]], edges: List[Tuple[int, int]]) -> bytes:
+    global _treeimg_pool
+    if _treeimg_pool is None:
+        # spawn: workers start clean instead of forking the event loop, sockets and DB connections
+        _treeimg_pool = ProcessPoolExecutor(max_workers=TREEIMG_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    async with _treeimg_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_treeimg_pool, tree_render.render_tree_png, nodes, edges)
+
+async def shutdown_treeimg_pool():
+    global _treeimg_pool
+    if _treeimg_pool is not None:
+        _treeimg_pool.shutdown(wait=False, cancel_futures=True)
+        _treeimg_pool = None
+
+def _treeimg_node(tid: int, user: Optional[User], balance_minor: int = 0) -> Tuple[int, str, str]:
+    if user:
+        label = f"{user.first_name or user.username or 'ID:'+str(tid)}\\nID:{tid}\\nBal:{fmt_minor(balance_minor)}\\nRef:{user.referrals_count}"
+        color = ROLE_COLOR.get((user.role or "guest").lower(), "lightgray")
+    else:
+        label = f"ID:{tid}"
+        color = "lightgray"
+    return tid, label, color
+
 @router.message(Command("treeimg"))
 async def cmd_treeimg(message: types.Message):
     if not GRAPHVIZ_AVAILABLE:
         await message.reply("Graphviz (python package yoki system 'dot') mavjud emas. O'rnatish: system: apt/brew/choco install graphviz; python: pip install graphviz")
         return
     root = message.from_user.id
-    nodes = {}
-    edges = []
-    queue = [(root, 0)]
-    visited = set()
+    caption = "🌳 Sizning referal daraxtingiz (rasm)"
+    version = get_subtree_version(root)
+    cached = TREEIMG_CACHE.get(root)
+    if cached and cached[0] == version:
+        TREEIMG_CACHE.move_to_end(root)
+        try:
+            await message.reply_photo(photo=cached[1], caption=caption)
+            return
+        except Exception:
+            logger.exception("cached treeimg file_id failed, re-rendering")
+            TREEIMG_CACHE.pop(root, None)
+    children_map = await load_tree_levels(root, MAX_TREE_DEPTH)
+    tids = [root] + [c.telegram_id for children in children_map.values() for c in children]
     async with AsyncSessionMaker() as session:
-        while queue:
-            cur_tid, level = queue.pop(0)
-            if cur_tid in visited:
-                continue
-            visited.add(cur_tid)
-            res = await session.execute(select(User).where(User.telegram_id == cur_tid))
-            cur_user = res.scalar_one_or_none()
-            if cur_user:
-                label = f"{cur_user.first_name or cur_user.username or 'ID:'+str(cur_tid)}\\nID:{cur_tid}\\nBal:{cur_user.balance:.2f}\\nRef:{cur_user.referrals_count}"
-                color = ROLE_COLOR.get((cur_user.role or "guest").lower(), "lightgray")
-            else:
-                label = f"ID:{cur_tid}"
-                color = "lightgray"
-            nodes[cur_tid] = {"label": label, "color": color, "role": getattr(cur_user, "role", "guest") if cur_user else "guest"}
-            if level < MAX_TREE_DEPTH:
-                res2 = await session.execute(select(User.telegram_id).where(User.referrer_telegram_id == cur_tid))
-                children = res2.scalars().all()
-                for child_tid in children:
-                    edges.append((cur_tid, child_tid))
-                    queue.append((child_tid, level+1))
-    # draw graph
-    dot = Digraph(format='png')
-    dot.attr('node', shape='record', fontsize='10')
-    for tid, meta in nodes.items():
-        dot.node(str(tid), label=meta["label"], style="filled", fillcolor=meta["color"])
-    for a,b in edges:
-        dot.edge(str(a), str(b))
-    # render to temp and send
+        root_user = await get_user_by_tid(session, root)
+        balances = await get_balances_minor(session, tids)
+    nodes = [_treeimg_node(root, root_user, balances.get(root, 0))]
+    edges = []
+    for parent, children in children_map.items():
+        for child in children:
+            nodes.append(_treeimg_node(child.telegram_id, child, balances.get(child.telegram_id, 0)))
+            edges.append((parent, child.telegram_id))
     try:
-        tmpdir = tempfile.mkdtemp()
-        out_path = os.path.join(tmpdir, f"tree_{root}")
-        png_path = dot.render(filename=out_path, cleanup=True)
-        await message.reply_photo(photo=FSInputFile(png_path), caption="🌳 Sizning referal daraxtingiz (rasm)")
+        png = await render_tree_png(nodes, edges)
+        sent = await message.reply_photo(photo=BufferedInputFile(png, filename=f"tree_{root}.png"), caption=caption)
+        if sent.photo:
+            TREEIMG_CACHE[root] = (version, sent.photo[-1].file_id)
+            TREEIMG_CACHE.move_to_end(root)
+            while len(TREEIMG_CACHE) > TREEIMG_CACHE_SIZE:
+                TREEIMG_CACHE.popitem(last=False)
     except Exception as e:
         logger.exception("Graphviz render error: %s", e)
         await message.reply("Rasm yaratishda xato yuz berdi. Graphviz o'rnatilganligini va python 'graphviz' paketini tekshiring.")
 
 @router.message(Command("downline"))
 async def cmd_downline(message: types.Message):
-    total = await count_downline(message.from_user.id)
+    # /downline <n>: only the first n levels, counted in referral_closure
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1].isdigit() and int(parts[1]) > 0:
+        depth = int(parts[1])
+        total = await count_downline(message.from_user.id, max_depth=depth)
+        return await message.reply(f"👥 {depth} darajagacha avlodlaringiz soni: {total}")
+    async with AsyncSessionMaker() as session:
+        u = await get_user_by_tid(session, message.from_user.id)
+    total = u.downline_total if u else 0
     await message.reply(f"👥 Sizning barcha avlodlaringiz soni: {total}")
 
+async def get_tree_stats(root_tid: int) -> Dict:
+    """
+    Subtree aggregates from referral_closure with two grouped queries:
+    per-level width and blocked count, plus total approved bonus paid to subtree members (root included).
+    """
+    async with AsyncSessionMaker() as session:
+        res = await session.execute(
+            select(
+                ReferralClosure.depth,
+                func.count(),
+                func.sum(case((User.blocked == True, 1), else_=0)),  # noqa: E712
+            )
+            .join(User, User.telegram_id == ReferralClosure.descendant_telegram_id)
+            .where(ReferralClosure.ancestor_telegram_id == root_tid, ReferralClosure.depth > 0)
+            .group_by(ReferralClosure.depth)
+            .order_by(ReferralClosure.depth)
+        )
+        levels = [(depth, count, blocked or 0) for depth, count, blocked in res.all()]
+        bonus_minor = (await session.execute(
+            select(func.coalesce(func.sum(Transaction.amount_minor), 0))
+            .join(ReferralClosure, ReferralClosure.descendant_telegram_id == Transaction.user_telegram_id)
+            .where(
+                ReferralClosure.ancestor_telegram_id == root_tid,
+                Transaction.type.in_(BONUS_TYPES),
+                Transaction.status == "approved",
+            )
+        )).scalar_one()
+    total = sum(count for _, count, _ in levels)
+    blocked = sum(b for _, _, b in levels)
+    return {
+        "levels": levels,
+        "total": total,
+        "max_depth": levels[-1][0] if levels else 0,
+        "blocked": blocked,
+        "blocked_share": (blocked / total) if total else 0.0,
+        "bonus_minor": bonus_minor,
+    }
+
+@router.message(Command("treestats"))
+async def cmd_treestats(message: types.Message):
+    parts = message.text.split()
+    root = message.from_user.id
+    if len(parts) > 1:
+        if message.from_user.id not in ALL_OWNER_IDS:
+            return await message.reply("Boshqa foydalanuvchi daraxtini faqat adminlar ko'ra oladi.")
+        if not parts[1].isdigit():
+            return await message.reply("Foydalanish: /treestats [telegram_id]")
+        root = int(parts[1])
+    st = await get_tree_stats(root)
+    if not st["total"]:
+        return await message.reply(f"{root} daraxtida hali hech kim yo'q 🌱")
+    lines = [
+        f"📈 Daraxt statistikasi — root {root}\n",
+        f"Jami a'zolar: {st['total']}",
+        f"Maksimal chuqurlik: {st['max_depth']}",
+        f"Bloklanganlar: {st['blocked']} ({st['blocked_share'] * 100:.1f}%)",
+        f"Daraxtga to'langan bonuslar: {fmt_minor(st['bonus_minor'])}\n",
+        "Darajalar bo'yicha:",
+    ]
+    for depth, count, blocked in st["levels"]:
+        lines.append(f"L{depth}: {count}" + (f" (blocked {blocked})" if blocked else ""))
+    await reply_long(message, "\n".join(lines))
+
+TOP_DEFAULT = 10
+TOP_MAX = 50
+
+async def render_top(n: int) -> str:
+    boards = {name: board.top(n) for name, board in LEADERBOARDS.items()}
+    tids = {tid for rows in boards.values() for tid, _ in rows}
+    async with AsyncSessionMaker() as session:
+        res = await session.execute(select(User.telegram_id, User.username, User.first_name).where(User.telegram_id.in_(list(tids))))
+        names = {tid: (f"@{username}" if username else first_name) or str(tid) for tid, username, first_name in res.all()}
+    titles = {
+        "direct": "👥 To'g'ridan-to'g'ri referallar",
+        "downline": "🌳 Jami avlodlar",
+        "bonus": "💰 Ishlangan bonus",
+    }
+    parts = [f"🏆 Top {n}"]
+    for name, rows in boards.items():
+        parts.append(f"\n{titles[name]}:")
+        if not rows:
+            parts.append("—")
+        for i, (tid, score) in enumerate(rows, start=1):
+            value = fmt_minor(score) if name == "bonus" else str(score)
+            parts.append(f"{i}. {html.escape(names.get(tid, str(tid)))} — {value}")
+    return "\n".join(parts)
+
+@router.message(Command("top"))
+async def cmd_top(message: types.Message):
+    parts = message.text.split()
+    n = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else TOP_DEFAULT
+    await reply_long(message, await render_top(min(max(n, 1), TOP_MAX)))
+
+@router.callback_query(F.data == "admin_top")
+async def cb_admin_top(call: types.CallbackQuery):
+    if call.from_user.id not in ALL_OWNER_IDS:
+        return await call.answer("Ruxsat yo'q", show_alert=True)
+    await call.message.answer(await render_top(TOP_DEFAULT))
+    await call.answer()
+
 @router.message(Command("me"))
 async def cmd_me(message: types.Message):
-    async with AsyncSessionMaker() as session:
-        u = await get_user_by_tid(session, message.from_user.id)
+    u, balance, levels = await get_user_profile(message.from_user.id)
     if not u:
         await message.reply("Siz ro'yxatda yo'q.")
         return
+    levels_text = ", ".join(f"L{d}: {c}" for d, c in levels.items()) or "—"
     await message.reply(
         f"👤 {u.first_name or u.username} (@{u.username or '—'})\n"
         f"ID: {u.telegram_id}\n"
         f"Rol: {u.role}\n"
         f"Direct referrals: {u.referrals_count}\n"
-        f"Balance: {u.balance:.2f}\n"
+        f"Downline: {u.downline_total} ({levels_text})\n"
+        f"Balance: {fmt_minor(balance)}\n"
         f"Blocked: {'✅' if u.blocked else '❌'}"
     )
 
 @router.message(Command("balance"))
 async def cmd_balance(message: types.Message):
-    async with AsyncSessionMaker() as session:
-        u = await get_user_by_tid(session, message.from_user.id)
-    bal = u.balance if u else 0.0
-    await message.reply(f"💳 Sizning balansingiz: {bal:.2f}")
+    bal = (await get_user_profile(message.from_user.id)).balance_minor
+    await message.reply(f"💳 Sizning balansingiz: {fmt_minor(bal)}")
 
 @router.message(Command("withdraw"))
 async def cmd_withdraw(message: types.Message):
@@ -498,33 +2674,71 @@ async def cmd_withdraw(message: types.Message):
         amount = float(parts[1])
     except:
         return await message.reply("Summa noto'g'ri. Raqam kiriting (masalan 100 yoki 50.5).")
-    if amount <= 0:
+    if not is_valid_amount(amount):
         return await message.reply("Summa musbat bo'lishi kerak.")
-    # check balance
-    async with AsyncSessionMaker() as session:
-        u = await get_user_by_tid(session, message.from_user.id)
+    # check balance (the guarded approval re-checks it against the ledger)
+    u, balance, _ = await get_user_profile(message.from_user.id)
     if not u:
         return await message.reply("Siz ro'yxatda mavjud emassiz.")
-    if (u.balance or 0.0) < amount:
+    if balance < to_minor(amount):
         return await message.reply("Sizning balansingizda yetarli mablag' yo'q.")
     tx = await create_withdraw_request(message.from_user.id, amount, method="manual")
     await message.reply(f"💸 Yechib olish so'rovi qabul qilindi. TX_ID: {tx.id}. Admin tasdiqlashini kuting.")
-    # notify owners
-    for owner in ALL_OWNER_IDS:
-        try:
-            await bot.send_message(owner, f"💸 Yangi withdraw so'rovi\nUser: {message.from_user.id}\nAmount: {amount:.2f}\nTX_ID: {tx.id}\n/confirm_withdraw {tx.id}  yoki /decline_withdraw {tx.id}")
-        except Exception:
-            pass
+    # owners get it in the next withdraw digest
+    withdraw_digest.add(tx.id, message.from_user.id, message.from_user.username, to_minor(amount))
+    withdraw_expiry.push(tx.id, tx.created_at)
+
+async def render_tx_history(user_tid: int, page: int, cursor_id: Optional[int] = None, direction: str = "n"):
+    """History page text + keyboard. Callback data: txh:<n|p>:<cursor tx id>:<page> and txh:dl."""
+    txs, more = await get_user_transactions_page(user_tid, TX_HISTORY_PER_PAGE, cursor_id, direction)
+    if not txs:
+        return None, None
+    has_older = more if direction == "n" else True
+    has_newer = page > 1 if direction == "n" else more
+    lines = [f"🧾 Sizning tranzaksiyalaringiz (sahifa {page}):\n"]
+    for t in txs:
+        lines.append(f"ID:{t.id} | {t.type} | {fmt_tx_amount(t.type, t.amount_minor)} | {t.status} | {t.created_at.strftime('%Y-%m-%d %H:%M')}")
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="⬅ Yangiroq", callback_data=f"txh:p:{txs[0].id}:{max(page - 1, 1)}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Eskiroq ➡", callback_data=f"txh:n:{txs[-1].id}:{page + 1}"))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text="📥 To'liq tarixni yuklab olish", callback_data="txh:dl")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
 
 @router.message(Command("transactions"))
 async def cmd_transactions(message: types.Message):
-    txs = await list_user_transactions(message.from_user.id)
-    if not txs:
+    text, kb = await render_tx_history(message.from_user.id, 1)
+    if not text:
         return await message.reply("Tranzaksiyalar topilmadi.")
-    lines = []
-    for t in txs:
-        lines.append(f"ID:{t.id} | {t.type} | {t.amount:.2f} | {t.status} | {t.created_at.strftime('%Y-%m-%d %H:%M')}")
-    await message.reply("🧾 Sizning tranzaksiyalaringiz:\n\n" + "\n".join(lines))
+    await reply_long(message, text, reply_markup=kb)
+
+@router.callback_query(F.data.startswith("txh:"))
+async def cb_tx_history(call: types.CallbackQuery):
+    user_tid = call.from_user.id
+    if call.data == "txh:dl":
+        await call.answer("⏳ Fayl tayyorlanmoqda...")
+        path = await export_transactions_csv(user_tid=user_tid)
+        if not path:
+            return await call.message.answer("Tranzaksiyalar topilmadi.")
+        try:
+            await bot.send_document(call.message.chat.id, FSInputFile(path, filename=f"transactions_{user_tid}.csv"), caption="🧾 To'liq tranzaksiyalar tarixi")
+        finally:
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+        return
+    _, direction, cursor_s, page_s = call.data.split(":")
+    text, kb = await render_tx_history(user_tid, int(page_s), int(cursor_s), direction)
+    if not text:
+        return await call.answer("Boshqa tranzaksiya yo'q.")
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await call.answer()
 
 # -----------------------
 # ADMIN HANDLERS (owner/admins)
@@ -533,11 +2747,12 @@ def admin_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🌳 Mening daraxtim", callback_data="admin_tree_me"),
          InlineKeyboardButton(text="🔍 Foydalanuvchi qidir", callback_data="admin_find")],
-        [InlineKeyboardButton(text="📤 Foydalanuvchiga yozish", callback_data="admin_write")],
+        [InlineKeyboardButton(text="📤 Ommaviy xabar", callback_data="admin_write")],
         [InlineKeyboardButton(text="🚫 Bloklash", callback_data="admin_block"),
          InlineKeyboardButton(text="✅ Blokdan chiqarish", callback_data="admin_unblock")],
         [InlineKeyboardButton(text="📊 Statistikalar", callback_data="admin_stats"),
-         InlineKeyboardButton(text="👥 Foydalanuvchilar", callback_data="admin_users")]
+         InlineKeyboardButton(text="👥 Foydalanuvchilar", callback_data="admin_users")],
+        [InlineKeyboardButton(text="🏆 Top referallar", callback_data="admin_top")]
     ])
 
 @router.message(Command("panel"))
@@ -546,6 +2761,59 @@ async def cmd_panel(message: types.Message):
         return
     await message.reply("🛠 Admin panel", reply_markup=admin_kb())
 
+async def render_stats() -> str:
+    async with AsyncSessionMaker() as session:
+        total = await get_users_total(session)
+    c = user_cache.stats()
+    t = throttling.stats()
+    return (
+        "📊 Statistika\n\n"
+        f"Foydalanuvchilar: {total}\n\n"
+        f"User cache: {c['size']}/{user_cache.maxsize} yozuv, TTL {user_cache.ttl:.0f}s\n"
+        f"Hit: {c['hits']} | Miss: {c['misses']} | Hit rate: {c['hit_rate'] * 100:.1f}%\n\n"
+        f"Throttling: {t['tracked_users']} ta foydalanuvchi kuzatilmoqda\n"
+        f"Tashlab yuborildi: user limit {t['user']} | global limit {t['global']}"
+    )
+
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    await message.reply(await render_stats())
+
+@router.callback_query(F.data == "admin_stats")
+async def cb_admin_stats(call: types.CallbackQuery):
+    if call.from_user.id not in ALL_OWNER_IDS:
+        return await call.answer("Ruxsat yo'q", show_alert=True)
+    await call.message.answer(await render_stats())
+    await call.answer()
+
+def withdraw_select_kb(tx_ids: List[int], selected: set) -> InlineKeyboardMarkup:
+    """Toggle buttons (callback wsel:t:<id>) three per row, plus select-all and approve-selected."""
+    buttons = [
+        InlineKeyboardButton(text=f"{'☑️' if tx_id in selected else '⬜'} #{tx_id}", callback_data=f"wsel:t:{tx_id}")
+        for tx_id in tx_ids
+    ]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([
+        InlineKeyboardButton(text="☑️ Hammasini tanlash", callback_data="wsel:all"),
+        InlineKeyboardButton(text="✅ Tanlanganlarni tasdiqlash", callback_data="wsel:go"),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def read_withdraw_selection(markup: Optional[InlineKeyboardMarkup]) -> Tuple[List[int], set]:
+    """The selection lives in the keyboard itself (button marks), so it survives restarts."""
+    tx_ids: List[int] = []
+    selected = set()
+    for row in (markup.inline_keyboard if markup else []):
+        for b in row:
+            if b.callback_data and b.callback_data.startswith("wsel:t:"):
+                tx_id = int(b.callback_data.rsplit(":", 1)[1])
+                tx_ids.append(tx_id)
+                if b.text.startswith("☑️"):
+                    selected.add(tx_id)
+    return tx_ids, selected
+
 @router.message(Command("withdraw_requests"))
 async def cmd_withdraw_requests(message: types.Message):
     if message.from_user.id not in ALL_OWNER_IDS:
@@ -556,34 +2824,80 @@ async def cmd_withdraw_requests(message: types.Message):
     lines = []
     for t in pending:
         lines.append(f"ID:{t.id} | User:{t.user_telegram_id} | {t.amount:.2f} | created:{t.created_at.strftime('%Y-%m-%d %H:%M')}")
-    await message.reply("🔔 Pending withdraws:\n\n" + "\n".join(lines) + "\n\nUse /confirm_withdraw <tx_id> yoki /decline_withdraw <tx_id>")
+    kb = withdraw_select_kb([t.id for t in pending[:WITHDRAW_SELECT_MAX]], set())
+    await reply_long(
+        message,
+        "🔔 Pending withdraws:\n\n" + "\n".join(lines)
+        + "\n\nUse /confirm_withdraw <tx_id> [tx_id ...] [note] yoki /decline_withdraw <tx_id>"
+        + (f"\nTugmalar: eng eski {WITHDRAW_SELECT_MAX} ta so'rov" if len(pending) > WITHDRAW_SELECT_MAX else ""),
+        reply_markup=kb,
+    )
+
+def render_batch_result(results: Dict[int, Tuple[str, Optional[int]]]) -> str:
+    by_result: Dict[str, List[int]] = {}
+    for tx_id, (res, _) in sorted(results.items()):
+        by_result.setdefault(res, []).append(tx_id)
+    lines = [f"Withdraw batch: {len(results)} ta"]
+    for res, ids in by_result.items():
+        lines.append(f"{WITHDRAW_RESULT_TEXT.get(res, res)}: {', '.join(map(str, ids))}")
+    return "\n".join(lines)
+
+def notify_batch_users(results: Dict[int, Tuple[str, Optional[int]]], note: Optional[str] = None) -> None:
+    """Queues the "approved" message for every approved row of a batch (declines stay silent, as before)."""
+    for tx_id, (res, user_tid) in results.items():
+        if user_tid and res == "approved":
+            user_notifier.add(user_tid, withdraw_user_text(tx_id, True, note))
 
 @router.message(Command("confirm_withdraw"))
 async def cmd_confirm_withdraw(message: types.Message):
     if message.from_user.id not in ALL_OWNER_IDS:
         return
-    parts = message.text.split(maxsplit=2)
-    if len(parts) < 2 or not parts[1].isdigit():
-        return await message.reply("Foydalanish: /confirm_withdraw <tx_id> [note]")
-    tx_id = int(parts[1])
-    note = parts[2] if len(parts) > 2 else None
-    res = await process_withdraw(tx_id, message.from_user.id, approve=True, note=note)
-    if res == "not_found":
-        return await message.reply("TX topilmadi.")
-    if res == "already_processed":
-        return await message.reply("TX allaqachon qayta ishlangan.")
-    if res == "insufficient_balance":
-        return await message.reply("Foydalanuvchi balansida yetarli mablag' yo'q — tranzaksiya bekor qilindi.")
-    if res == "approved":
-        await message.reply("✅ Tranzaksiya tasdiqlandi va balansdan yechildi.")
-        # notify user
-        user_tid = await get_user_tid_from_tx(tx_id)
-        if user_tid:
-            try:
-                await bot.send_message(user_tid, f"💰 Sizning withdraw so'rovingiz (ID:{tx_id}) tasdiqlandi. Sizga tashqi to'lov amalga oshirilgan.")
-            except Exception:
-                pass
-        return
+    parts = message.text.split()[1:]
+    tx_ids = []
+    while parts and parts[0].isdigit():
+        tx_ids.append(int(parts.pop(0)))
+    if not tx_ids:
+        return await message.reply("Foydalanish: /confirm_withdraw <tx_id> [tx_id ...] [note]")
+    note = " ".join(parts) or None
+    results = await process_withdraws_batch(tx_ids, message.from_user.id, note=note)
+    notify_batch_users(results)
+    if len(results) == 1:
+        res = next(iter(results.values()))[0]
+        text = {
+            "approved": "✅ Tranzaksiya tasdiqlandi va balansdan yechildi.",
+            "insufficient_balance": "Foydalanuvchi balansida yetarli mablag' yo'q — tranzaksiya bekor qilindi.",
+        }.get(res, WITHDRAW_RESULT_TEXT.get(res, res))
+        return await message.reply(text)
+    await reply_long(message, render_batch_result(results))
+
+@router.callback_query(F.data.startswith("wsel:"))
+async def cb_withdraw_select(call: types.CallbackQuery):
+    """Selection keyboard of /withdraw_requests: toggle (wsel:t:<id>), select all, approve selected."""
+    if call.from_user.id not in ALL_OWNER_IDS:
+        return await call.answer("Ruxsat yo'q", show_alert=True)
+    tx_ids, selected = read_withdraw_selection(call.message.reply_markup if call.message else None)
+    if call.data == "wsel:go":
+        if not selected:
+            return await call.answer("Hech narsa tanlanmagan.", show_alert=True)
+        await call.answer("⏳ Tasdiqlanmoqda...")
+        results = await process_withdraws_batch(sorted(selected), call.from_user.id)
+        notify_batch_users(results)
+        remaining = [tx_id for tx_id in tx_ids if tx_id not in results]
+        try:
+            await call.message.edit_reply_markup(reply_markup=withdraw_select_kb(remaining, set()) if remaining else None)
+        except TelegramBadRequest:
+            pass
+        return await call.message.answer(render_batch_result(results))
+    if call.data == "wsel:all":
+        selected = set(tx_ids)
+    else:
+        tx_id = int(call.data.rsplit(":", 1)[1])
+        selected ^= {tx_id}
+    try:
+        await call.message.edit_reply_markup(reply_markup=withdraw_select_kb(tx_ids, selected))
+    except TelegramBadRequest:
+        pass
+    await call.answer(f"Tanlangan: {len(selected)} ta")
 
 @router.message(Command("decline_withdraw"))
 async def cmd_decline_withdraw(message: types.Message):
@@ -601,14 +2915,49 @@ async def cmd_decline_withdraw(message: types.Message):
         return await message.reply("TX allaqachon qayta ishlangan.")
     if res == "declined":
         await message.reply("❌ Tranzaksiya rad etildi.")
-        user_tid = await get_user_tid_from_tx(tx_id)
-        if user_tid:
-            try:
-                await bot.send_message(user_tid, f"❌ Sizning withdraw so'rovingiz (ID:{tx_id}) rad etildi. Sabab: {note or '—'}")
-            except Exception:
-                pass
+        await notify_withdraw_user(tx_id, approved=False, note=note)
         return
 
+def withdraw_user_text(tx_id: int, approved: bool, note: Optional[str] = None) -> str:
+    if approved:
+        return f"💰 Sizning withdraw so'rovingiz (ID:{tx_id}) tasdiqlandi. Sizga tashqi to'lov amalga oshirilgan."
+    return f"❌ Sizning withdraw so'rovingiz (ID:{tx_id}) rad etildi. Sabab: {note or '—'}"
+
+async def notify_withdraw_user(tx_id: int, approved: bool, note: Optional[str] = None):
+    user_tid = await get_user_tid_from_tx(tx_id)
+    if user_tid:
+        user_notifier.add(user_tid, withdraw_user_text(tx_id, approved, note))
+
+WITHDRAW_RESULT_TEXT = {
+    "approved": "✅ Tasdiqlandi",
+    "declined": "❌ Rad etildi",
+    "not_found": "TX topilmadi.",
+    "already_processed": "TX allaqachon qayta ishlangan.",
+    "insufficient_balance": "Balans yetarli emas — rad etildi.",
+    "user_not_found": "Foydalanuvchi topilmadi — rad etildi.",
+}
+
+@router.callback_query(F.data.startswith("wd:"))
+async def cb_withdraw_digest(call: types.CallbackQuery):
+    """Approve/decline buttons of the owner withdraw digest."""
+    if call.from_user.id not in ALL_OWNER_IDS:
+        return await call.answer("Ruxsat yo'q", show_alert=True)
+    _, action, tx_id_s = call.data.split(":")
+    tx_id = int(tx_id_s)
+    approve = action == "ok"
+    res = await process_withdraw(tx_id, call.from_user.id, approve=approve)
+    await call.answer(f"TX {tx_id}: {WITHDRAW_RESULT_TEXT.get(res, res)}", show_alert=res not in ("approved", "declined"))
+    if res in ("approved", "declined"):
+        await notify_withdraw_user(tx_id, approved=approve)
+    # drop the processed transaction's buttons from the digest
+    if call.message and call.message.reply_markup:
+        rows = [row for row in call.message.reply_markup.inline_keyboard
+                if not any(b.callback_data and b.callback_data.endswith(f":{tx_id}") for b in row)]
+        try:
+            await call.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=rows) if rows else None)
+        except TelegramBadRequest:
+            pass
+
 async def get_user_tid_from_tx(tx_id: int) -> Optional[int]:
     async with AsyncSessionMaker() as session:
         res = await session.execute(select(Transaction).where(Transaction.id == tx_id))
@@ -632,6 +2981,85 @@ async def cmd_export_withdraws(message: types.Message):
         except Exception:
             pass
 
+def parse_export_args(args: List[str]) -> Dict:
+    """
+    Parses `/export_tx` options: type=<t> status=<s> from=YYYY-MM-DD to=YYYY-MM-DD gz.
+    `to` is inclusive (whole day). Raises ValueError on bad input.
+    """
+    opts: Dict = {}
+    for arg in args:
+        if arg.lower() in ("gz", "gzip"):
+            opts["compress"] = True
+            continue
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            raise ValueError(arg)
+        key = key.lower()
+        if key == "type":
+            opts["tx_type"] = value
+        elif key == "status":
+            opts["status"] = value
+        elif key == "from":
+            opts["date_from"] = datetime.strptime(value, "%Y-%m-%d")
+        elif key == "to":
+            opts["date_to"] = datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)
+        else:
+            raise ValueError(arg)
+    return opts
+
+@router.message(Command("export_tx"))
+async def cmd_export_tx(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    try:
+        opts = parse_export_args(message.text.split()[1:])
+    except ValueError:
+        return await message.reply("Foydalanish: /export_tx [type=bonus|bonus_adjustment|withdraw|manual] [status=pending|approved|declined|expired] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [gz]")
+    path = await export_transactions_csv(**opts)
+    if not path:
+        return await message.reply("Filtrga mos tranzaksiya topilmadi.")
+    try:
+        await bot.send_document(message.chat.id, FSInputFile(path, filename=os.path.basename(path)), caption="Transactions CSV")
+    except Exception as e:
+        await message.reply(f"CSV yuborishda xato: {e}")
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+@router.message(Command("export_tree"))
+async def cmd_export_tree(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    args = message.text.split()[1:]
+    usage = "Foydalanish: /export_tree <telegram_id> [json|graphml] [depth=N]"
+    if not args or not args[0].isdigit():
+        return await message.reply(usage)
+    root = int(args[0])
+    fmt, max_depth = "json", None
+    for arg in args[1:]:
+        if arg.lower() in ("json", "graphml"):
+            fmt = arg.lower()
+        elif arg.lower().startswith("depth=") and arg[6:].isdigit():
+            max_depth = int(arg[6:])
+        else:
+            return await message.reply(usage)
+    await message.reply("⏳ Daraxt eksport qilinmoqda...")
+    path = await export_subtree(root, fmt=fmt, max_depth=max_depth)
+    if not path:
+        return await message.reply("Foydalanuvchi topilmadi.")
+    ext = "graphml.gz" if fmt == "graphml" else "ndjson.gz"
+    try:
+        await bot.send_document(message.chat.id, FSInputFile(path, filename=f"tree_{root}.{ext}"), caption=f"🌳 {root} daraxti ({fmt})")
+    except Exception as e:
+        await message.reply(f"Fayl yuborishda xato: {e}")
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
 @router.message(Command("manual_payout"))
 async def cmd_manual_payout(message: types.Message):
     if message.from_user.id not in ALL_OWNER_IDS:
@@ -644,6 +3072,8 @@ async def cmd_manual_payout(message: types.Message):
         amount = float(parts[2])
     except:
         return await message.reply("telegram_id va amount to'g'ri formatda bo'lishi kerak.")
+    if not is_valid_amount(amount):
+        return await message.reply("Summa musbat bo'lishi kerak.")
     method = parts[3] if len(parts) > 3 else "manual"
     note = " ".join(parts[4:]) if len(parts) > 4 else None
     res = await manual_payout(message.from_user.id, user_tid, amount, method=method, note=note)
@@ -657,6 +3087,219 @@ async def cmd_manual_payout(message: types.Message):
     except Exception:
         pass
 
+IMPORT_USAGE = (
+    "Foydalanish: CSV faylni <code>/import_users [rewards]</code> izohi bilan yuboring.\n"
+    "Ustunlar: telegram_id,referrer_id[,username[,first_name]]\n"
+    "<code>rewards</code> — LEVEL_REWARDS bonuslarini ham yozish."
+)
+
+@router.message(Command("import_users"))
+async def cmd_import_users(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    if not message.document:
+        return await message.reply(IMPORT_USAGE)
+    replay = "rewards" in (message.caption or "").lower().split()[1:]
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        await bot.download(message.document, destination=path)
+        rows, errors = await asyncio.to_thread(parse_import_csv, path)
+    except Exception as e:
+        return await message.reply(f"Faylni o'qishda xato: {e}")
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+    if not rows:
+        return await message.reply("Import uchun yaroqli qator topilmadi.\n" + "\n".join(errors[:10]))
+
+    status = await message.reply(f"⏳ Import boshlandi: {len(rows)} ta qator...")
+    last_edit = 0.0
+
+    async def progress(done: int, total: int):
+        nonlocal last_edit
+        now = time.monotonic()
+        if done < total and now - last_edit < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = now
+        try:
+            await status.edit_text(f"⏳ Import: {done}/{total}")
+        except Exception:
+            pass
+
+    try:
+        stats = await import_referral_rows(rows, replay_rewards=replay, progress=progress)
+    except Exception as e:
+        logger.exception("import_users failed")
+        return await message.reply(f"Importda xato: {html.escape(str(e))}")
+    head = "✅ Import tugadi"
+    if stats.get("error"):
+        head = f"⚠️ Import yarim yo'lda to'xtadi: {html.escape(stats['error'])}"
+    text = (
+        f"{head}\n"
+        f"Qo'shildi: {stats['imported']}\n"
+        f"Allaqachon bor: {stats['skipped_existing']}\n"
+        f"Tsikl sabab o'tkazildi: {stats['cyclic']}\n"
+        f"Bonus yozuvlari: {stats['bonus_rows']}\n"
+        f"Xato qatorlar: {len(errors)}"
+    )
+    if errors:
+        text += "\n\n" + "\n".join(html.escape(e) for e in errors[:20])
+    await reply_long(message, text)
+
+@router.message(Command("recompute_rewards"))
+async def cmd_recompute_rewards(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    args = message.text.split()[1:]
+    apply = bool(args) and args[-1].lower() == "apply"
+    if apply:
+        args = args[:-1]
+    try:
+        rewards = parse_level_rewards(" ".join(args)) or dict(LEVEL_REWARDS)
+        check_level_rewards(rewards)
+    except ValueError:
+        return await message.reply(
+            "Foydalanish: /recompute_rewards [1:100 2:50 ...] [apply]\n"
+            "Jadval berilmasa joriy LEVEL_REWARDS tekshiriladi; apply bo'lmasa faqat farqlar hisoblanadi."
+        )
+    table = format_level_rewards(rewards)
+    status = await message.reply(f"⏳ Bonuslar qayta hisoblanmoqda ({table})...")
+    last_edit = time.monotonic()
+
+    async def progress(done: int, total: int):
+        nonlocal last_edit
+        now = time.monotonic()
+        if now - last_edit < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = now
+        try:
+            await status.edit_text(f"⏳ Bonuslar qayta hisoblanmoqda: {done}/{total}")
+        except Exception:
+            pass
+
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        stats = await recompute_rewards(rewards, apply=apply, csv_path=path, progress=progress)
+        text = (
+            f"{'✅ Tuzatildi' if apply else '🔎 Dry-run'} ({table})\n"
+            f"Farqli foydalanuvchilar: {stats['users']}\n"
+            f"Qo'shiladi: {fmt_minor(stats['credit_minor'])}\n"
+            f"Ayriladi: {fmt_minor(stats['debit_minor'])}"
+        )
+        if stats["users"]:
+            await bot.send_document(message.chat.id, FSInputFile(path, filename="reward_deltas.csv"), caption=text)
+        else:
+            await message.reply(text)
+    except Exception as e:
+        await message.reply(f"Qayta hisoblashda xato: {e}")
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+BROADCAST_USAGE = (
+    "📣 Ommaviy xabar:\n"
+    "<code>/broadcast [role=guest] [blocked=all] matn</code>\n"
+    "yoki istalgan xabarga reply qilib <code>/broadcast [role=...] [blocked=all]</code> — xabar nusxalanadi.\n"
+    "Bloklangan (admin tomonidan) foydalanuvchilar sukut bo'yicha o'tkazib yuboriladi.\n"
+    "/broadcast_status [id], /broadcast_cancel &lt;id&gt;"
+)
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    parts = (message.text or message.caption or "").split(maxsplit=1)
+    rest = parts[1] if len(parts) > 1 else ""
+    role, include_blocked = None, False
+    while True:
+        head, _, tail = rest.partition(" ")
+        if head.startswith("role="):
+            role = head[5:] or None
+        elif head in ("blocked=all", "blocked=yes"):
+            include_blocked = True
+        else:
+            break
+        rest = tail.lstrip()
+    source = None
+    if message.reply_to_message:
+        source = (message.chat.id, message.reply_to_message.message_id)
+    elif not rest.strip():
+        return await message.reply(BROADCAST_USAGE)
+    # the admin gets the first copy: text Telegram rejects (bad HTML, too long) fails here, not for every user
+    try:
+        if source:
+            await bot.copy_message(message.chat.id, *source)
+        else:
+            await bot.send_message(message.chat.id, rest)
+    except TelegramBadRequest as e:
+        return await message.reply(f"❌ Xabarni yuborib bo'lmadi, broadcast boshlanmadi: {html.escape(e.message)}")
+    bc_id = await create_broadcast(message.from_user.id, text=None if source else rest, source=source, role=role, include_blocked=include_blocked)
+    await message.reply(f"📣 Broadcast #{bc_id} boshlandi. Holat: /broadcast_status {bc_id}")
+
+@router.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    parts = message.text.split()
+    async with AsyncSessionMaker() as session:
+        q = select(Broadcast).order_by(Broadcast.id.desc()).limit(1)
+        if len(parts) > 1 and parts[1].isdigit():
+            q = select(Broadcast).where(Broadcast.id == int(parts[1]))
+        bc = (await session.execute(q)).scalar_one_or_none()
+    if not bc:
+        return await message.reply("Broadcast topilmadi.")
+    await message.reply(
+        f"📣 Broadcast #{bc.id} — {bc.status}\n"
+        f"Filtr: role={bc.role or 'hammasi'}, blocked={'all' if bc.include_blocked else 'no'}\n"
+        f"Yuborildi: {bc.sent}\nXato: {bc.failed}\nBotni bloklaganlar: {bc.bot_blocked}\n"
+        f"Checkpoint: {bc.last_telegram_id}"
+    )
+
+@router.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return await message.reply("Foydalanish: /broadcast_cancel <id>")
+    ok = await cancel_broadcast(int(parts[1]))
+    await message.reply("⛔ Broadcast to'xtatildi." if ok else "Bu broadcast ishlamayapti.")
+
+@router.callback_query(F.data == "admin_write")
+async def cb_admin_write(call: types.CallbackQuery):
+    if call.from_user.id not in ALL_OWNER_IDS:
+        return await call.answer("Ruxsat yo'q", show_alert=True)
+    await call.message.answer(BROADCAST_USAGE)
+    await call.answer()
+
+@router.message(Command("rebuild_closure"))
+async def cmd_rebuild_closure(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    await message.reply("⏳ Referal indeks qayta qurilmoqda...")
+    total = await rebuild_referral_closure()
+    await message.reply(f"✅ Referal indeks tayyor: {total} ta ajdod-avlod juftligi.")
+
+@router.message(Command("rebuild_counters"))
+async def cmd_rebuild_counters(message: types.Message):
+    if message.from_user.id not in ALL_OWNER_IDS:
+        return
+    parts = message.text.split()
+    apply = not (len(parts) > 1 and parts[1].lower() == "check")
+    stats = await rebuild_downline_counters(apply=apply)
+    status = "tuzatildi" if apply else "faqat tekshirildi"
+    await message.reply(
+        f"📊 Downline hisoblagichlari ({status}):\n"
+        f"Farqli foydalanuvchilar: {stats['users_drift']}\n"
+        f"Farqli daraja yozuvlari: {stats['levels_drift']}"
+    )
+
 # ROLE management (simple)
 @router.message(Command("setrole"))
 async def cmd_setrole(message: types.Message):
@@ -698,43 +3341,64 @@ async def cb_confirm_setrole(call: types.CallbackQuery):
 async def cb_cancel_setrole(call: types.CallbackQuery):
     await call.message.edit_text("❌ Amal bekor qilindi.")
 
-# Users list (paginated)
+# Users list (keyset-paginated on User.id; callback data: users_page:<page>:<n|p>:<cursor id>)
+USERS_PER_PAGE = 10
+
+async def render_users_page(page: int, direction: str, cursor: int):
+    """
+    direction "n": the page after cursor (id > cursor), "p": the page before it (id < cursor).
+    Fetches one extra row to know whether another page exists in that direction.
+    """
+    per_page = USERS_PER_PAGE
+    async with AsyncSessionMaker() as session:
+        total = await get_users_total(session)
+        if direction == "p":
+            res = await session.execute(select(User).where(User.id < cursor).order_by(User.id.desc()).limit(per_page + 1))
+            users = list(res.scalars().all())
+            has_prev, has_next = len(users) > per_page, True
+            users = users[:per_page][::-1]
+        else:
+            res = await session.execute(select(User).where(User.id > cursor).order_by(User.id).limit(per_page + 1))
+            users = list(res.scalars().all())
+            has_prev, has_next = page > 1, len(users) > per_page
+            users = users[:per_page]
+        balances = await get_balances_minor(session, [u.telegram_id for u in users])
+    total_pages = max((total + per_page - 1) // per_page, page, 1)
+    lines = [f"📋 Foydalanuvchilar — Sahifa {page}/{total_pages}"]
+    for u in users:
+        lines.append(f"{u.telegram_id} | {u.first_name or u.username} | {u.role} | bal:{fmt_minor(balances.get(u.telegram_id))} | ref:{u.referrer_telegram_id} | dl:{u.downline_total}")
+    buttons = []
+    if users and has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅ Oldingi", callback_data=f"users_page:{page-1}:p:{users[0].id}"))
+    if users and has_next:
+        buttons.append(InlineKeyboardButton(text="Keyingi ➡", callback_data=f"users_page:{page+1}:n:{users[-1].id}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), kb
+
 @router.message(Command("users"))
 async def cmd_users(message: types.Message):
     if message.from_user.id not in ALL_OWNER_IDS:
         return
-    per_page = 10; page = 1
-    async with AsyncSessionMaker() as session:
-        total = (await session.execute(select(func.count(User.id)))).scalar_one()
-        total_pages = max((total + per_page - 1) // per_page, 1)
-        res = await session.execute(select(User).order_by(User.id).limit(per_page).offset(0))
-        users = res.scalars().all()
-    lines = [f"📋 Foydalanuvchilar — Sahifa {page}/{total_pages}"]
-    for u in users:
-        lines.append(f"{u.telegram_id} | {u.first_name or u.username} | {u.role} | bal:{u.balance:.2f} | ref:{u.referrer_telegram_id}")
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton("Keyingi ➡", callback_data=f"users_page:{page+1}")]] ) if page < total_pages else None
-    await message.reply("\n".join(lines), reply_markup=kb)
+    text, kb = await render_users_page(1, "n", 0)
+    await message.reply(text, reply_markup=kb)
 
 @router.callback_query(F.data.startswith("users_page:"))
 async def cb_users_page(call: types.CallbackQuery):
     if call.from_user.id not in ALL_OWNER_IDS:
         return await call.answer("Ruxsat yo'q", show_alert=True)
-    page = int(call.data.split(":",1)[1]); per_page = 10
-    async with AsyncSessionMaker() as session:
-        total = (await session.execute(select(func.count(User.id)))).scalar_one()
-        total_pages = max((total + per_page - 1) // per_page, 1)
-        offset = (page - 1) * per_page
-        res = await session.execute(select(User).order_by(User.id).limit(per_page).offset(offset))
-        users = res.scalars().all()
-    lines = [f"📋 Foydalanuvchilar — Sahifa {page}/{total_pages}"]
-    for u in users:
-        lines.append(f"{u.telegram_id} | {u.first_name or u.username} | {u.role} | bal:{u.balance:.2f} | ref:{u.referrer_telegram_id}")
-    buttons = []
-    if page > 1: buttons.append(InlineKeyboardButton("⬅ Oldingi", callback_data=f"users_page:{page-1}"))
-    if page < total_pages: buttons.append(InlineKeyboardButton("Keyingi ➡", callback_data=f"users_page:{page+1}"))
-    kb = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
-    await call.message.delete()
-    await bot.send_message(call.message.chat.id, "\n".join(lines), reply_markup=kb)
+    try:
+        _, page_s, direction, cursor_s = call.data.split(":")
+        page, cursor = max(int(page_s), 1), int(cursor_s)
+    except ValueError:
+        # buttons from before keyset pagination: start over
+        page, direction, cursor = 1, "n", 0
+    text, kb = await render_users_page(page, direction, cursor)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        # "message is not modified" on double taps
+        pass
+    await call.answer()
 
 # set owner commands
 async def set_owner_commands():
@@ -743,10 +3407,20 @@ async def set_owner_commands():
             commands=[
                 types.BotCommand(command="panel", description="Admin panel"),
                 types.BotCommand(command="users", description="Foydalanuvchilar"),
+                types.BotCommand(command="stats", description="Statistika (cache)"),
+                types.BotCommand(command="top", description="Top referallar"),
                 types.BotCommand(command="withdraw_requests", description="Withdraw so'rovlari"),
                 types.BotCommand(command="export_withdraws", description="Export withdraws CSV"),
+                types.BotCommand(command="export_tx", description="Export transactions CSV (filters)"),
+                types.BotCommand(command="export_tree", description="Daraxtni JSON/GraphML eksport"),
                 types.BotCommand(command="setrole", description="Rol berish"),
                 types.BotCommand(command="manual_payout", description="Qo'lda payout"),
+                types.BotCommand(command="rebuild_closure", description="Referal indeksni qayta qurish"),
+                types.BotCommand(command="rebuild_counters", description="Downline hisoblagichlarini tekshirish"),
+                types.BotCommand(command="import_users", description="Foydalanuvchilarni CSV dan import"),
+                types.BotCommand(command="recompute_rewards", description="Bonuslarni qayta hisoblash"),
+                types.BotCommand(command="broadcast", description="Ommaviy xabar"),
+                types.BotCommand(command="broadcast_status", description="Broadcast holati"),
             ],
             scope=BotCommandScopeChat(chat_id=OWNER_ID)
         )
@@ -761,6 +3435,7 @@ async def set_owner_commands():
 async def check_bot_token() -> bool:
     try:
         me = await bot.get_me()
+        bot_identity.set(me)
         logger.info(f"Bot connected as @{me.username} (id={me.id})")
         return True
     except TelegramUnauthorizedError:
@@ -784,8 +3459,16 @@ async def main():
     # Keyin handlerlarni registratsiya qilamiz
     # dp.errors.register(error_handler)
     dp.startup.register(create_db)
+    dp.startup.register(load_level_rewards)
+    dp.startup.register(ensure_referral_closure)
+    dp.startup.register(migrate_legacy_balances)
+    dp.startup.register(load_leaderboards)
+    dp.startup.register(load_referral_graph)
+    dp.startup.register(start_background_tasks)
     dp.startup.register(notify_owners_startup)
     dp.shutdown.register(notify_owners_shutdown)
+    dp.shutdown.register(shutdown_treeimg_pool)
+    dp.shutdown.register(stop_background_tasks)
 
     await set_owner_commands()
     logger.info("Bot launching...")
@@ -0,0 +1,217 @@
+import asyncio
+from array import array
+from itertools import accumulate
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class ReferralGraph:
+    """
+    Array-backed referral forest kept in memory:
+    telegram_id -> dense slot (dict), slot -> telegram_id / parent slot (array('q'), -1 = root),
+    children in CSR form (offsets + one flat child array, in insertion order) built by build().
+    Nodes added later go to a small overflow map; once it grows past max(4096, n / 8) entries,
+    add() folds it back into the CSR arrays with compact_async() (a background task when an event
+    loop is running, otherwise compact() in place).
+    Walks are cycle-safe, so legacy referrer loops in the users table cannot hang them.
+    """
+
+    COMPACT_CHUNK = 8192  # slots merged per event-loop step by compact_async()
+
+    def __init__(self):
+        self.loaded = False
+        self._slot: Dict[int, int] = {}
+        self._tid = array("q")
+        self._parent = array("q")
+        self._offsets = array("q", [0])
+        self._children = array("q")
+        self._extra: Dict[int, List[int]] = {}
+        self._extra_count = 0
+        # overflow being merged by compact_async(): still read by walks until the new arrays are swapped in
+        self._merging: Dict[int, List[int]] = {}
+        self._generation = 0
+        self._compact_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._tid)
+
+    def __contains__(self, telegram_id: int) -> bool:
+        return telegram_id in self._slot
+
+    def build(self, rows: Iterable[Tuple[int, Optional[int]]]) -> None:
+        """rows: (telegram_id, referrer_telegram_id) in users.id order; unknown referrers become roots."""
+        slot: Dict[int, int] = {}
+        tids = array("q")
+        refs: List[Optional[int]] = []
+        for tid, ref in rows:
+            if tid in slot:
+                continue
+            slot[tid] = len(tids)
+            tids.append(tid)
+            refs.append(ref if ref != tid else None)
+        get = slot.get
+        self._slot, self._tid = slot, tids
+        self._parent = array("q", [get(ref, -1) for ref in refs])
+        self._build_csr()
+        self.loaded = True
+
+    def _build_csr(self) -> None:
+        """offsets/children from the parent array: a stable sort of slots by parent keeps children in slot order."""
+        parent = self._parent
+        n = len(parent)
+        counts = [0] * (n + 1)
+        for p in parent:
+            counts[p + 1] += 1  # roots (-1) land in counts[0]
+        roots = counts[0]
+        counts[0] = 0
+        order = sorted(range(n), key=parent.__getitem__)
+        self._offsets = array("q", accumulate(counts))
+        self._children = array("q", order[roots:])
+        self._extra, self._extra_count, self._merging = {}, 0, {}
+        self._generation += 1
+
+    def add(self, telegram_id: int, referrer_tid: Optional[int] = None) -> None:
+        if telegram_id in self._slot:
+            return
+        s = len(self._tid)
+        p = self._slot.get(referrer_tid, -1) if referrer_tid is not None else -1
+        self._slot[telegram_id] = s
+        self._tid.append(telegram_id)
+        self._parent.append(p)
+        self._offsets.append(self._offsets[-1])  # no CSR children yet
+        if p >= 0:
+            self._extra.setdefault(p, []).append(s)
+            self._extra_count += 1
+            if self._extra_count > max(4096, len(self._tid) // 8) and self._compact_task is None:
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    self.compact()
+                else:
+                    self._compact_task = loop.create_task(self.compact_async())
+
+    def compact(self) -> None:
+        """Rebuilds the CSR arrays so overflow children become contiguous again (O(n log n), blocking)."""
+        self._build_csr()
+
+    async def compact_async(self) -> None:
+        """
+        Merges the current overflow into new CSR arrays COMPACT_CHUNK slots at a time, yielding to the
+        event loop between chunks, then swaps them in. Nodes added meanwhile go to a fresh overflow map
+        and walks keep reading the old arrays plus the overflow being merged.
+        """
+        try:
+            generation = self._generation
+            merging, self._merging = self._extra, self._extra
+            self._extra, self._extra_count = {}, 0
+            n = len(self._tid)
+            old_off, old_ch = self._offsets, self._children
+            new_off = array("q", [0])
+            new_ch = array("q")
+            chunk = self.COMPACT_CHUNK
+            buckets: Dict[int, List[int]] = {}  # chunk number -> parents with overflow children in it
+            keys = list(merging)
+            for j in range(0, len(keys), chunk):
+                for p in keys[j:j + chunk]:
+                    buckets.setdefault(p // chunk, []).append(p)
+                await asyncio.sleep(0)
+            for start in range(0, n, chunk):
+                end = min(n, start + chunk)
+                pos = old_off[start]
+                shift = len(new_ch) - pos
+                seg_start = start
+                for p in sorted(buckets.get(start // chunk, ())):
+                    new_ch.extend(old_ch[pos:old_off[p + 1]])
+                    new_off.extend(x + shift for x in old_off[seg_start + 1:p + 1])
+                    new_ch.extend(merging[p])
+                    shift += len(merging[p])
+                    new_off.append(old_off[p + 1] + shift)
+                    pos, seg_start = old_off[p + 1], p + 1
+                new_ch.extend(old_ch[pos:old_off[end]])
+                new_off.extend(x + shift for x in old_off[seg_start + 1:end + 1])
+                await asyncio.sleep(0)
+                if self._generation != generation:
+                    return  # rebuilt by build()/compact() meanwhile
+            # slots appended while merging have no CSR children yet
+            new_off.extend([len(new_ch)] * (len(self._tid) - n))
+            self._offsets, self._children, self._merging = new_off, new_ch, {}
+            self._generation += 1
+        finally:
+            self._compact_task = None
+
+    def _child_slots(self, s: int) -> List[int]:
+        kids = self._children[self._offsets[s]:self._offsets[s + 1]].tolist()
+        merging = self._merging.get(s)
+        if merging:
+            kids += merging
+        extra = self._extra.get(s)
+        return kids + extra if extra else kids
+
+    def parent(self, telegram_id: int) -> Optional[int]:
+        s = self._slot.get(telegram_id)
+        if s is None or self._parent[s] < 0:
+            return None
+        return self._tid[self._parent[s]]
+
+    def children(self, telegram_id: int) -> List[int]:
+        s = self._slot.get(telegram_id)
+        if s is None:
+            return []
+        return [self._tid[c] for c in self._child_slots(s)]
+
+    def ancestors(self, telegram_id: int, limit: Optional[int] = None) -> List[int]:
+        """Parent, grandparent, ... (nearest first), at most `limit` of them."""
+        s = self._slot.get(telegram_id)
+        out: List[int] = []
+        if s is None:
+            return out
+        seen = {s}
+        p = self._parent[s]
+        while p >= 0 and p not in seen and (limit is None or len(out) < limit):
+            out.append(self._tid[p])
+            seen.add(p)
+            p = self._parent[p]
+        return out
+
+    def levels(self, root_tid: int, max_depth: int) -> Dict[int, List[int]]:
+        """parent telegram_id -> child telegram_ids for the subtree of root_tid, down to max_depth levels."""
+        s = self._slot.get(root_tid)
+        children_map: Dict[int, List[int]] = {}
+        if s is None:
+            return children_map
+        seen = {s}
+        frontier = [s]
+        for _ in range(max_depth):
+            next_frontier: List[int] = []
+            for p in frontier:
+                kids = [c for c in self._child_slots(p) if c not in seen]
+                if kids:
+                    seen.update(kids)
+                    children_map[self._tid[p]] = [self._tid[c] for c in kids]
+                    next_frontier.extend(kids)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return children_map
+
+    def level_counts(self, root_tid: int, max_depth: Optional[int] = None) -> Dict[int, int]:
+        """depth -> number of descendants at that depth."""
+        s = self._slot.get(root_tid)
+        counts: Dict[int, int] = {}
+        if s is None:
+            return counts
+        seen = {s}
+        frontier = [s]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_frontier = [c for p in frontier for c in self._child_slots(p) if c not in seen]
+            seen.update(next_frontier)
+            if next_frontier:
+                counts[depth] = len(next_frontier)
+            frontier = next_frontier
+        return counts
+
+    def memory_bytes(self) -> int:
+        """Approximate footprint of the arrays and the id -> slot dict (ints shared with the arrays excluded)."""
+        arrays = sum(a.buffer_info()[1] * a.itemsize for a in (self._tid, self._parent, self._offsets, self._children))
+        return arrays + self._slot.__sizeof__() + 28 * 2 * len(self._slot)
@@ -0,0 +1,49 @@
+import logging
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+
+logger = logging.getLogger("sqlite_engine")
+
+# connection-level PRAGMAs applied on every new SQLite connection
+DEFAULT_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",        # readers don't block the writer and vice versa
+    "synchronous": "NORMAL",      # fsync on checkpoint, not on every commit (safe with WAL)
+    "busy_timeout": 5000,         # ms to wait for a lock instead of "database is locked"
+    "cache_size": -64000,         # negative = KiB, so ~64 MB page cache
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+def create_engine_for(url: str, *, pragmas: Optional[dict] = None, pool_size: int = 5, max_overflow: int = 10, **kwargs) -> AsyncEngine:
+    """
+    Shared async engine factory. For sqlite+aiosqlite file databases it applies the tuned
+    PRAGMA profile above on connect and uses a small connection pool; any other URL gets
+    a plain create_async_engine(). Extra kwargs go to create_async_engine.
+    """
+    kwargs.setdefault("echo", False)
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite" or parsed.database in (None, "", ":memory:"):
+        return create_async_engine(url, **kwargs)
+
+    settings = dict(DEFAULT_SQLITE_PRAGMAS)
+    settings.update(pragmas or {})
+    connect_args = kwargs.pop("connect_args", {})
+    # the sqlite3 driver's own lock wait, in seconds
+    connect_args.setdefault("timeout", settings["busy_timeout"] / 1000)
+    engine = create_async_engine(url, pool_size=pool_size, max_overflow=max_overflow, connect_args=connect_args, **kwargs)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in settings.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    logger.info("SQLite engine tuned: %s", ", ".join(f"{k}={v}" for k, v in settings.items()))
+    return engine
@@ -20,6 +20,7 @@ from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyb
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.exceptions import TelegramUnauthorizedError
 from aiogram.enums import ParseMode
+from bot_identity import BotIdentityCache
 
 
 # SQLAlchemy async
@@ -108,6 +109,7 @@ storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+bot_identity = BotIdentityCache(bot, ttl=int(os.getenv("BOT_ME_TTL", str(6 * 3600))))
 
 # -----------------------
 # DB helpers
@@ -363,7 +365,7 @@ async def cmd_start(message: types.Message):
         if a.isdigit():
             ref = int(a)
     created = await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name, ref)
-    bot_username = (await bot.get_me()).username
+    bot_username = await bot_identity.username()
     ref_link = f"https://t.me/{bot_username}?start={message.from_user.id}"
     if not created:
         await message.reply(f"Siz allaqachon ro'yxatda bo'lgansiz ✅\nSizning referal link: {ref_link}")
@@ -750,6 +752,7 @@ async def set_owner_commands():
 async def check_bot_token() -> bool:
     try:
         me = await bot.get_me()
+        bot_identity.set(me)
         logger.info(f"Bot connected as @{me.username} (id={me.id})")
         return True
     except TelegramUnauthorizedError:
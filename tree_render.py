@@ -0,0 +1,22 @@
+from typing import List, Tuple
+
+try:
+    from graphviz import Digraph
+    GRAPHVIZ_AVAILABLE = True
+except Exception:
+    GRAPHVIZ_AVAILABLE = False
+
+
+def render_tree_png(nodes: List[Tuple[int, str, str]], edges: List[Tuple[int, int]]) -> bytes:
+    """
+    Runs in a /treeimg worker process: builds the Digraph and pipes it through `dot` (no temp files).
+    Kept out of referal_pro_bot.py so spawned workers only need graphviz, not aiogram/SQLAlchemy.
+    nodes: (telegram_id, label, fill color); edges: (parent telegram_id, child telegram_id).
+    """
+    dot = Digraph(format='png')
+    dot.attr('node', shape='record', fontsize='10')
+    for tid, label, color in nodes:
+        dot.node(str(tid), label=label, style="filled", fillcolor=color)
+    for a, b in edges:
+        dot.edge(str(a), str(b))
+    return dot.pipe()